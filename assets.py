@@ -0,0 +1,171 @@
+import os, hashlib
+from PIL import Image, ImageFont
+from tracing import traced
+from output import encode, write_atomic
+
+SUITS_PATH = "images/suits.png"
+SUIT_SIZE = 192 # each suit is a 192x192 cell of suits.png
+
+ROTATIONS = {
+    90: Image.ROTATE_90,
+    180: Image.ROTATE_180,
+    270: Image.ROTATE_270,
+}
+
+
+class AssetStore(object):
+    # Maps (source, size, rotation, resample) to a ready image. source is an
+    # image path or a suit index into suits.png; resample=None means PIL's
+    # default filter, for call sites that never passed one. Images handed
+    # out are shared, so callers must copy before drawing on them.
+    #
+    # With a cache_dir, resized/rotated images are also written to disk,
+    # named after the source file's content hash so stale copies are never
+    # picked up again.
+    #
+    # Keys being loaded in the background (see preload.py) are waited for
+    # instead of being loaded a second time.
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir
+        self._images = {}
+        self._fonts = {}
+        self._digests = {}
+        self._pending = {}
+
+    def image_key(self, source, size=None, rotation=0,
+                  resample=Image.ANTIALIAS):
+        if size is not None:
+            size = (int(size[0]), int(size[1]))
+        return (source, size, rotation, resample)
+
+    def get(self, source, size=None, rotation=0, resample=Image.ANTIALIAS):
+        key = self.image_key(source, size, rotation, resample)
+        img = self._images.get(key)
+        if img is None:
+            self._wait(key)
+            img = self._images.get(key)
+        if img is None:
+            img = self._images[key] = self._load(key)
+        return img
+
+    def font(self, path, size, encoding=""):
+        # fonts are shared too; ImageFont objects aren't drawn on
+        key = ("font", path, size, encoding)
+        font = self._fonts.get(key)
+        if font is None:
+            self._wait(key)
+            font = self._fonts.get(key)
+        if font is None:
+            font = self._fonts[key] = ImageFont.truetype(path, size,
+                                                         encoding=encoding)
+        return font
+
+    def fill(self, key):
+        # loads an image or font key (see image_key and font) without waiting
+        # on pending work, for the background loader itself
+        if key[0] == "font":
+            if key not in self._fonts:
+                _, path, size, encoding = key
+                self._fonts[key] = ImageFont.truetype(path, size,
+                                                      encoding=encoding)
+        elif key not in self._images:
+            self._images[key] = self._load(key)
+
+    def loaded(self, key):
+        return key in (self._fonts if key[0] == "font" else self._images)
+
+    def expect(self, key, pending):
+        # pending.wait() returns once key has been filled (or has failed,
+        # in which case get loads it again and raises)
+        self._pending[key] = pending
+
+    def _wait(self, key):
+        pending = self._pending.get(key)
+        if pending is not None:
+            pending.wait()
+            self._pending.pop(key, None)
+
+    def source_size(self, source):
+        # reads only the header when the decoded image isn't needed
+        if isinstance(source, int):
+            return (SUIT_SIZE, SUIT_SIZE)
+        key = (source, None, 0, Image.ANTIALIAS)
+        if key in self._images:
+            return self._images[key].size
+        return Image.open(source).size
+
+    def source_path(self, source):
+        return SUITS_PATH if isinstance(source, int) else source
+
+    def source_digest(self, source):
+        # rehash only when the file's mtime or size changes
+        path = self.source_path(source)
+        st = os.stat(path)
+        sig = (st.st_mtime, st.st_size)
+        cached = self._digests.get(path)
+        if cached is None or cached[0] != sig:
+            f = open(path, "rb")
+            cached = self._digests[path] = (sig, hashlib.sha1(f.read()).hexdigest())
+            f.close()
+        return cached[1]
+
+    def clear(self):
+        self._images.clear()
+        self._fonts.clear()
+
+    @traced("AssetStore.load", lambda self, key: {"source": key[0],
+                                                  "size": key[1],
+                                                  "rotation": key[2]})
+    def _load(self, key):
+        source, size, rotation, resample = key
+        if size is None and rotation == 0:
+            return self._decode(source)
+
+        derived = self._derived_path(key)
+        if derived is not None and os.path.exists(derived):
+            img = Image.open(derived)
+            img.load()
+            return img
+
+        # derive from the memoized original if there is one, but don't keep
+        # big originals around just because one resized copy was asked for
+        img = self._images.get((source, None, 0, Image.ANTIALIAS))
+        if img is None:
+            img = self._decode(source)
+        if size is not None:
+            if resample is None:
+                img = img.resize(size)
+            else:
+                img = img.resize(size, resample)
+        if rotation:
+            img = img.transpose(ROTATIONS[rotation])
+
+        if derived is not None:
+            write_atomic(derived, encode(img, "png"))
+        return img
+
+    def _decode(self, source):
+        if isinstance(source, int):
+            x = source * SUIT_SIZE
+            return self.get(SUITS_PATH).crop((x, 0, x + SUIT_SIZE, SUIT_SIZE))
+        img = Image.open(source)
+        img.load()
+        return img
+
+    def _derived_path(self, key):
+        if self.cache_dir is None:
+            return None
+        if not os.path.isdir(self.cache_dir):
+            try:
+                os.makedirs(self.cache_dir)
+            except OSError: # another worker got there first
+                pass
+        source, size, rotation, resample = key
+        name = repr((source, self.source_digest(source), size, rotation,
+                     resample))
+        return os.path.join(self.cache_dir,
+                            hashlib.sha1(name.encode("utf-8")).hexdigest() + ".png")
+
+
+# shared by CardMaker, Card.draw_back and the puzzle cards
+ASSETS = AssetStore()
@@ -0,0 +1,150 @@
+import os, json, hashlib
+from PIL import Image
+from output import OutputWriter, write_atomic
+from pyramid import half
+
+# Packs rendered cards into a few power-of-two texture atlases for the
+# digital table client, plus a manifest.json of where each card landed:
+#
+#   {"atlases": [{"file": "atlas0_0.png", "level": 0, "size": [4096, 4096]}],
+#    "cards": {"star10": [{"atlas": 0, "rect": [x, y, w, h],
+#                          "uv": [u0, v0, u1, v1]}, ...one per mip level]}}
+#
+# uv is normalized with (0, 0) at the top left of the atlas. Cards that
+# render to identical pixels share one rectangle.
+
+MANIFEST_VERSION = 1
+
+def _pow2(n):
+    size = 1
+    while size < n:
+        size *= 2
+    return size
+
+
+class ShelfPacker(object):
+    # Fills one max_size square page at a time with rows ("shelves") of
+    # images, left to right and top to bottom, padding pixels apart so mip
+    # sampling doesn't bleed between neighbours. A full page is handed to
+    # save(page_number, img) cropped to the smallest power of two around
+    # what was placed on it.
+    def __init__(self, max_size, padding, save):
+        self.max_size = max_size
+        self.padding = padding
+        self.save = save
+        self.sizes = [] # final (w, h) of each saved page
+        self._page = None
+
+    def _new_page(self):
+        self._page = Image.new("RGBA", (self.max_size, self.max_size))
+        self._x = self._y = self.padding
+        self._shelf = 0
+        self._used = (0, 0)
+
+    def add(self, img):
+        # returns (page number, (x, y, w, h))
+        w, h = img.size
+        p = self.padding
+        if w + 2 * p > self.max_size or h + 2 * p > self.max_size:
+            raise ValueError("a %dx%d image doesn't fit in a %d atlas" % (
+                w, h, self.max_size))
+        if self._page is None:
+            self._new_page()
+        if self._x + w + p > self.max_size:
+            self._x, self._y = p, self._y + self._shelf + p
+            self._shelf = 0
+        if self._y + h + p > self.max_size:
+            self.flush()
+            self._new_page()
+
+        x, y = self._x, self._y
+        self._page.paste(img, (x, y))
+        self._x += w + p
+        self._shelf = max(self._shelf, h)
+        self._used = (max(self._used[0], x + w + p),
+                      max(self._used[1], y + h + p))
+        return len(self.sizes), (x, y, w, h)
+
+    def flush(self):
+        if self._page is None:
+            return
+        size = (_pow2(self._used[0]), _pow2(self._used[1]))
+        self.save(len(self.sizes), self._page.crop((0, 0) + size))
+        self.sizes.append(size)
+        self._page = None
+
+
+class AtlasWriter(object):
+    # levels is the number of mip levels: level n is level 0 at 1 / 2**n
+    # size, each packed into atlases of its own. Files are encoded on the
+    # output threads, see output.OutputWriter. Cards are handed back to
+    # pool (see buffers.py) once packed.
+    def __init__(self, path, max_size=4096, levels=1, padding=2, dedupe=True,
+                 level=6, encoders=2, pool=None):
+        # pages are padded up to a power of two, so max_size must be one
+        if max_size < 1 or _pow2(max_size) != max_size:
+            raise ValueError("atlas size %d is not a power of two" % max_size)
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self.path = path
+        self.levels = levels
+        self.dedupe = dedupe
+        self.pool = pool
+        self.writer = OutputWriter(path, "png", level, encoders)
+        self.packers = [ShelfPacker(max_size, padding,
+                                    lambda page, img, lvl=lvl:
+                                        self.writer.put(self._name(lvl, page),
+                                                        img))
+                        for lvl in range(levels)]
+        self.cards = {}
+        self.duplicates = 0
+        self._seen = {}
+
+    def _name(self, lvl, page):
+        return "atlas%d_%d" % (lvl, page)
+
+    def put(self, name, img):
+        digest = hashlib.sha1(img.mode + str(img.size) + img.tobytes()).digest()
+        if self.dedupe and digest in self._seen:
+            self.cards[name] = self.cards[self._seen[digest]]
+            self.duplicates += 1
+        else:
+            self._seen[digest] = name
+            placements, mip = [], img
+            for lvl, packer in enumerate(self.packers):
+                if lvl:
+                    mip = half(mip)
+                placements.append(packer.add(mip))
+            self.cards[name] = placements
+        if self.pool is not None:
+            self.pool.release(img)
+
+    def format_stats(self, render_time):
+        return "%s; %d duplicate cards" % (
+            self.writer.format_stats(render_time), self.duplicates)
+
+    def close(self):
+        for packer in self.packers:
+            packer.flush()
+        self.writer.close()
+
+        atlases, index = [], {}
+        for lvl, packer in enumerate(self.packers):
+            for page, size in enumerate(packer.sizes):
+                index[lvl, page] = len(atlases)
+                atlases.append({"file": self._name(lvl, page) + ".png",
+                                "level": lvl, "size": list(size)})
+        cards = {}
+        for name, placements in self.cards.items():
+            cards[name] = []
+            for lvl, (page, (x, y, w, h)) in enumerate(placements):
+                aw, ah = self.packers[lvl].sizes[page]
+                cards[name].append({
+                    "atlas": index[lvl, page], "rect": [x, y, w, h],
+                    "uv": [float(x) / aw, float(y) / ah,
+                           float(x + w) / aw, float(y + h) / ah]})
+        manifest = {"version": MANIFEST_VERSION, "atlases": atlases,
+                    "cards": cards}
+        write_atomic(os.path.join(self.path, "manifest.json"),
+                     json.dumps(manifest, indent=2, sort_keys=True))
+        return manifest
@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+
+# Times each stage of the card pipeline separately.
+#
+#   python bench.py -o baseline.json
+#   python bench.py --baseline baseline.json --threshold 15
+#
+# The second form fails (exit status 1) if any stage's best time is more
+# than threshold percent (and at least --min-delta ms) slower than in the
+# baseline. Either form also fails if a card rendered with the numpy
+# compositor takes more than --composite-ratio times as long as the same
+# card through the paste path.
+
+import os, sys, io, json, time, argparse, platform, resource, tempfile
+import PIL
+
+from card import Card, MASK_CACHE, rounded_rect_mask, W, H, CUT_W, CUT_H
+from buffers import POOL
+from sheet import SheetWriter
+from variants import HATCH_COLORS
+from imposition import PageSpec, ImpositionPlan
+from make_deck import CardMaker, render_job, load_jobs
+from puzzle_cards import PuzzleText, PuzzleRound
+
+
+# (composite stage, the same card through the paste path)
+COMPOSITE_PAIRS = [
+    ("render_card_10_composite", "render_card_10"),
+    ("render_facecard_13_composite", "render_facecard_13"),
+]
+
+
+def timed(fn, repeat):
+    fn() # warm up per-process caches first
+    times = []
+    for _ in range(repeat):
+        start = time.time()
+        fn()
+        times.append(time.time() - start)
+    return {"best": min(times), "mean": sum(times) / len(times), "runs": repeat}
+
+def first_job(jobs, kind, num=None):
+    # the deck's first card of a kind (and number), whatever the deck spec
+    # calls its suits
+    for job in jobs:
+        if job.kind == kind and (num is None or job.args[0] == num):
+            return job
+    raise ValueError("the deck spec has no %s card%s" % (
+        kind, " %d" % num if num is not None else ""))
+
+def stages(cm, jobs):
+    ul = (W/2 - CUT_W/2, H/2 - CUT_H/2)
+    br = (W/2 + CUT_W/2, H/2 + CUT_H/2)
+    card = Card()
+    _, codes, tricks, scores = first_job(jobs, "round").args
+
+    def uncached_card():
+        MASK_CACHE.clear()
+        Card(guides="CS")
+
+    def draw_back():
+        Card().draw_back()
+
+    def cut():
+        POOL.release(Card().flush(cut=True))
+
+    def draw_back_hatch():
+        Card().draw_back(HATCH_COLORS[0], HATCH_COLORS[1])
+
+    def draw_corners():
+        cm._draw_corners(Card(), 12, 3, allfour=True)
+
+    def sheet():
+        img = cm.make_card(5, 0).img
+        path = tempfile.mktemp(suffix=".png")
+        try:
+            writer = SheetWriter(path, (4 * int(W), 2 * int(H)), int(H))
+            for r in range(2):
+                for c in range(4):
+                    writer.paste(img, (c * int(W), r * int(H)))
+            writer.close()
+        finally:
+            os.remove(path)
+
+    # whole cards through render_job, cut included, with and without the
+    # numpy compositor; the canvases go back to the pool as in make_deck
+    ccm = CardMaker(composite=True)
+    ten = first_job(jobs, "card", 10)
+    king = first_job(jobs, "face", 13)
+
+    def render(cm, job):
+        POOL.release(render_job(cm, job))
+
+    def imposition_plan():
+        ImpositionPlan(["card%d" % i for i in range(62)],
+                       PageSpec(duplex="long"), decks=4)
+
+    def png_encode():
+        card.img.save(io.BytesIO(), "PNG")
+
+    ret = [
+        ("rounded_rect_mask", lambda: rounded_rect_mask(card.size(), ul+br, 50,
+                                                        int(CUT_W - 1))),
+        ("card_init", lambda: Card()),
+        ("card_init_uncached", uncached_card),
+        ("cut_mask", card.cut_mask),
+        ("cut_in_place", cut),
+        ("draw_back", draw_back),
+        ("draw_back_hatch", draw_back_hatch),
+    ]
+    for num in range(1, 11):
+        ret.append(("make_card_%d" % num,
+                    lambda num=num: cm.make_card(num, 0)))
+    for num in range(11, 14):
+        ret.append(("make_facecard_%d" % num,
+                    lambda num=num: cm.make_facecard(num, 0)))
+    ret += [
+        ("make_special", lambda: cm.make_special("D")),
+        ("draw_corners", draw_corners),
+        ("puzzle_text", lambda: PuzzleText(guides="").make_card()),
+        ("puzzle_round", lambda: PuzzleRound(1, codes, tricks, scores,
+                                             guides="").make_card()),
+        ("render_card_10", lambda: render(cm, ten)),
+        ("render_card_10_composite", lambda: render(ccm, ten)),
+        ("render_facecard_13", lambda: render(cm, king)),
+        ("render_facecard_13_composite", lambda: render(ccm, king)),
+        ("sheet", sheet),
+        ("imposition_plan", imposition_plan),
+        ("png_encode", png_encode),
+    ]
+    return ret
+
+def run(repeat, only=None, deck_spec=None):
+    jobs = load_jobs(deck_spec)
+    start = time.time()
+    cm = CardMaker()
+    results = {"card_maker_init": {"best": time.time() - start, "mean": None,
+                                   "runs": 1}}
+    for name, fn in stages(cm, jobs):
+        if only and name not in only:
+            continue
+        results[name] = timed(fn, repeat)
+
+    return {
+        "meta": {"python": platform.python_version(), "pil": PIL.__version__,
+                 "platform": platform.platform(), "repeat": repeat,
+                 "time": time.strftime("%Y-%m-%d %H:%M:%S")},
+        "stages": results,
+        # kilobytes on Linux
+        "peak_rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+def compare(results, baseline, threshold, min_delta=0.0):
+    regressions = []
+    print("%-28s %10s %10s %8s" % ("stage", "base ms", "now ms", "change"))
+    for name in sorted(results["stages"]):
+        now = results["stages"][name]["best"]
+        if name not in baseline["stages"]:
+            print("%-28s %10s %10.2f %8s" % (name, "-", now * 1000, "new"))
+            continue
+        base = baseline["stages"][name]["best"]
+        change = 100.0 * (now - base) / base if base else 0.0
+        flag = ""
+        # very short stages are too noisy to judge by percentage alone
+        if change > threshold and now - base > min_delta:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print("%-28s %10.2f %10.2f %+7.1f%%%s" % (name, base * 1000, now * 1000,
+                                               change, flag))
+    return regressions
+
+def check_composite(results, ratio):
+    slow = []
+    for name, paste in COMPOSITE_PAIRS:
+        if name not in results["stages"] or paste not in results["stages"]:
+            continue
+        now = results["stages"][name]["best"]
+        base = results["stages"][paste]["best"]
+        flag = ""
+        if now > ratio * base:
+            slow.append(name)
+            flag = "  TOO SLOW"
+        print("%-28s %.2fx %s%s" % (name, now / base, paste, flag))
+    return slow
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark card rendering.")
+    parser.add_argument("-n", "--repeat", type=int, default=5)
+    parser.add_argument("-o", "--output", help="write results as JSON")
+    parser.add_argument("--stages", help="comma-separated stages to run")
+    parser.add_argument("--deck-spec", default=None,
+                        help="JSON deck spec to take the cards from "
+                        "(default: deck.json)")
+    parser.add_argument("--baseline", help="JSON results to compare against")
+    parser.add_argument("--threshold", type=float, default=10.0,
+                        help="allowed slowdown per stage, in percent")
+    parser.add_argument("--min-delta", type=float, default=0.5,
+                        help="ignore slowdowns smaller than this many ms")
+    parser.add_argument("--composite-ratio", type=float, default=4.0,
+                        help="allowed time of a composite render stage, as a "
+                             "multiple of its paste stage")
+    args = parser.parse_args()
+
+    only = args.stages.split(",") if args.stages else None
+    results = run(args.repeat, only, args.deck_spec)
+    if args.output:
+        f = open(args.output, "w")
+        json.dump(results, f, indent=2, sort_keys=True)
+        f.close()
+
+    if args.baseline:
+        f = open(args.baseline, "r")
+        baseline = json.loads(f.read())
+        f.close()
+        regressions = compare(results, baseline, args.threshold,
+                              args.min_delta / 1000.0)
+        if regressions:
+            print("%d stage(s) regressed more than %g%%: %s" % (
+                len(regressions), args.threshold, ", ".join(regressions)))
+            sys.exit(1)
+    elif not args.output:
+        for name in sorted(results["stages"]):
+            print("%-28s %10.2f ms" % (name, results["stages"][name]["best"] * 1000))
+    print("peak RSS: %d KB" % results["peak_rss"])
+
+    slow = check_composite(results, args.composite_ratio)
+    if slow:
+        print("%d composite stage(s) over %gx the paste path: %s" % (
+            len(slow), args.composite_ratio, ", ".join(slow)))
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
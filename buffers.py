@@ -0,0 +1,133 @@
+import threading, weakref
+from collections import deque
+from contextlib import contextmanager
+from PIL import Image
+
+# Card-sized canvases are reused instead of allocated fresh for every card.
+# A released image goes back on a free list for its (mode, size) and the
+# next acquire of that shape takes it from there, so a deck run allocates
+# only as many big buffers as are in flight at once: the card being drawn
+# plus whatever the output threads haven't encoded yet.
+#
+#   img = POOL.acquire("RGBA", size, "white")
+#   ...
+#   POOL.release(img) # once nothing reads img any more
+#
+# Releasing is optional; an image that's never released is just garbage
+# collected as before, and stops counting as live then.
+
+MAX_CARDS = 1024 # per-card rows kept for format_stats
+
+def _nbytes(img):
+    return img.size[0] * img.size[1] * len(img.getbands())
+
+
+class BufferPool(object):
+    def __init__(self, max_free=8):
+        self.max_free = max_free
+        self.allocations = self.reuses = 0
+        self.live_bytes = self.peak_bytes = 0
+        # (name, allocations, peak live bytes) for the last MAX_CARDS
+        # track()ed cards
+        self.cards = deque(maxlen=MAX_CARDS)
+        self._free = {}
+        # id -> (bytes, weakref) of the images handed out; the weakref drops
+        # the entry if the image is collected without being released
+        self._out = {}
+        self._card_peak = 0
+        # reentrant: a collection, and so _forget, can happen while held
+        self._lock = threading.RLock()
+
+    def acquire(self, mode, size, color=0):
+        # color=None skips clearing a reused image, for callers that are
+        # about to overwrite all of it anyway
+        key = (mode, tuple(size))
+        with self._lock:
+            free = self._free.setdefault(key, [])
+            img = free.pop() if free else None
+            if img is None:
+                self.allocations += 1
+            else:
+                self.reuses += 1
+        if img is None:
+            img = Image.new(mode, size, color or 0)
+        elif color is not None:
+            img.paste(color, (0, 0) + img.size)
+
+        with self._lock:
+            nbytes = _nbytes(img)
+            self._out[id(img)] = (nbytes,
+                                  weakref.ref(img, self._forget(id(img))))
+            self.live_bytes += nbytes
+            self.peak_bytes = max(self.peak_bytes, self.live_bytes)
+            self._card_peak = max(self._card_peak, self.live_bytes)
+        return img
+
+    def release(self, img):
+        # images the pool didn't hand out are taken too, if they have a
+        # shape it has handed out before; read-only ones (e.g. from
+        # Image.fromarray) would be copied on the first write, so aren't
+        key = (img.mode, img.size)
+        with self._lock:
+            self.live_bytes -= self._out.pop(id(img), (0, None))[0]
+            free = self._free.get(key)
+            if (free is None or len(free) >= self.max_free or img.readonly
+                    or any(_ is img for _ in free)):
+                return
+            free.append(img)
+
+    def _forget(self, ident):
+        def forget(ref):
+            with self._lock:
+                entry = self._out.get(ident)
+                if entry is not None and entry[1] is ref:
+                    del self._out[ident]
+                    self.live_bytes -= entry[0]
+        return forget
+
+    @contextmanager
+    def track(self, name):
+        # records the allocations made and the peak live bytes while name
+        # is being rendered
+        with self._lock:
+            allocations = self.allocations
+            self._card_peak = self.live_bytes
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.cards.append((name, self.allocations - allocations,
+                                   self._card_peak))
+
+    def reset_stats(self):
+        # start counting afresh, keeping the free lists
+        with self._lock:
+            self.allocations = self.reuses = 0
+            self.peak_bytes = self.live_bytes
+            self.cards.clear()
+
+    def clear(self):
+        with self._lock:
+            self._free.clear()
+            self._out.clear()
+            self.allocations = self.reuses = 0
+            self.live_bytes = self.peak_bytes = 0
+            self.cards.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"allocations": self.allocations, "reuses": self.reuses,
+                    "live_bytes": self.live_bytes,
+                    "peak_bytes": self.peak_bytes,
+                    "free": sum(len(_) for _ in self._free.values())}
+
+    def format_stats(self):
+        ret = "buffers: %d allocated, %d reused, peak %.1f MB live" % (
+            self.allocations, self.reuses, self.peak_bytes / 1e6)
+        if self.cards:
+            name, allocations, peak = max(self.cards, key=lambda c: c[2])
+            ret += "; per card at most %.1f MB (%s), %d allocations" % (
+                peak / 1e6, name, max(c[1] for c in self.cards))
+        return ret
+
+POOL = BufferPool()
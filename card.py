@@ -1,85 +1,248 @@
 import os, sys, math
+import numpy as np
 from PIL import Image, ImageDraw, ImageFont
+from cache import LRUCache
+from tracing import traced
+from composite import composite
+from buffers import POOL
 
 W, H = 822.0, 1122.0 # bridge dims: 747.0, 1122.0
 CUT_W, CUT_H = 750.0, 1050.0
 SAFE_W, SAFE_H = 678.0, 978.0
 
-def draw_rounded_rect(img, bbox, r, color, thickness):
-    draw = ImageDraw.Draw(img)
-
-    def thick_arc(box, corner):
-        x1, y1, x2, y2 = box
-        for x in range(x1, x2+1):
-            for y in range(y1, y2+1):
-                dist2 = (corner[0] - x)**2 + (corner[1] - y)**2
-                if r - thickness - 0.5 < math.sqrt(dist2) < r + 0.5:
-                    draw.point((x, y), color)
+# Masks and blank card bases depend only on geometry, so they are built once
+# per process and shared. Everything handed out from here is read-only.
+MASK_CACHE = LRUCache(maxsize=16)
 
+def rounded_rect_mask(size, bbox, r, thickness, supersample=1):
+    # Same shape as the old per-pixel loop: four straight bands plus four
+    # quarter rings, tested at each pixel center. With supersample > 1 each
+    # pixel averages supersample**2 sub-samples instead.
+    w, h = size
     rx1, ry1, rx2, ry2 = (int(_) for _ in bbox)
-    draw.rectangle(((rx1 + r, ry1), (rx2 - r, ry1 + thickness)), fill=color)
-    draw.rectangle(((rx1 + r, ry2 - thickness), (rx2 - r, ry2)), fill=color)
-    draw.rectangle(((rx1, ry1 + r), (rx1 + thickness, ry2 - r)), fill=color)
-    draw.rectangle(((rx2 - thickness, ry1 + r), (rx2, ry2 - r)), fill=color)
+    bands = [(rx1 + r, ry1, rx2 - r, ry1 + thickness),
+             (rx1 + r, ry2 - thickness, rx2 - r, ry2),
+             (rx1, ry1 + r, rx1 + thickness, ry2 - r),
+             (rx2 - thickness, ry1 + r, rx2, ry2 - r)]
+    arcs = [((rx1, ry1, rx1+r, ry1+r), (rx1+r, ry1+r)),
+            ((rx2-r, ry1, rx2, ry1+r), (rx2-r, ry1+r)),
+            ((rx1, ry2-r, rx1+r, ry2), (rx1+r, ry2-r)),
+            ((rx2-r, ry2-r, rx2, ry2), (rx2-r, ry2-r))]
+    shapes = [(box, None) for box in bands] + arcs
+
+    n = int(supersample)
+    steps = (np.arange(n) + 0.5) / n - 0.5
+    hits = np.zeros((h, w), np.uint32)
+    for oy in steps:
+        for ox in steps:
+            inside = np.zeros((h, w), bool)
+            for (x1, y1, x2, y2), corner in shapes:
+                # pixels whose samples can land in the box, clipped to the image
+                sx1, sy1 = max(x1 - 1, 0), max(y1 - 1, 0)
+                sx2, sy2 = min(x2 + 1, w - 1), min(y2 + 1, h - 1)
+                if sx1 > sx2 or sy1 > sy2:
+                    continue
+                xs = np.arange(sx1, sx2 + 1) + ox
+                ys = (np.arange(sy1, sy2 + 1) + oy)[:, None]
+                sel = ((xs >= x1 - 0.5) & (xs < x2 + 0.5) &
+                       (ys >= y1 - 0.5) & (ys < y2 + 0.5))
+                if corner is not None:
+                    dist = np.sqrt((corner[0] - xs)**2 + (corner[1] - ys)**2)
+                    sel &= (r - thickness - 0.5 < dist) & (dist < r + 0.5)
+                inside[sy1:sy2+1, sx1:sx2+1] |= sel
+            if n == 1:
+                return inside.astype(np.uint8) * 255
+            hits += inside
+
+    return ((hits * 255 + n * n // 2) // (n * n)).astype(np.uint8)
+
+def cached_mask(size, bbox, r, thickness, supersample=1):
+    key = ("L", tuple(size), tuple(int(_) for _ in bbox), r, thickness,
+           supersample)
+    return MASK_CACHE.get(key, lambda: Image.fromarray(
+        rounded_rect_mask(size, bbox, r, thickness, supersample), "L"))
+
+def cut_plan(mask):
+    # Clearing everything outside mask, split up by how much of the mask
+    # each part needs: a list of (box, mask crop), where a None crop means
+    # the box is entirely outside the mask and is simply filled. Rows and
+    # columns that are fully inside are left out, so for a rounded rect
+    # only the four corners need the mask at all.
+    m = np.asarray(mask)
+    h, w = m.shape
+    ys, xs = np.nonzero(m)
+    if not len(xs):
+        return [((0, 0, w, h), None)]
+    x1, y1, x2, y2 = xs.min(), ys.min(), xs.max() + 1, ys.max() + 1
+    plan = [(box, None) for box in ((0, 0, w, y1), (0, y2, w, h),
+                                    (0, y1, x1, y2), (x2, y1, w, y2))
+            if box[0] < box[2] and box[1] < box[3]]
+
+    full = m[y1:y2, x1:x2] == 255
+    rows = np.nonzero(full.all(1))[0]
+    cols = np.nonzero(full.all(0))[0]
+    if (not len(rows) or not len(cols) or rows[-1] - rows[0] + 1 != len(rows)
+            or cols[-1] - cols[0] + 1 != len(cols)):
+        boxes = [(x1, y1, x2, y2)]
+    else:
+        ix1, ix2 = x1 + cols[0], x1 + cols[-1] + 1
+        iy1, iy2 = y1 + rows[0], y1 + rows[-1] + 1
+        boxes = [box for box in ((x1, y1, ix1, iy1), (ix2, y1, x2, iy1),
+                                 (x1, iy2, ix1, y2), (ix2, iy2, x2, y2))
+                 if box[0] < box[2] and box[1] < box[3]]
+    for box in boxes:
+        box = tuple(int(_) for _ in box)
+        plan.append((box, mask.crop(box)))
+    return plan
+
+def cut_in_place(img, plan):
+    # same pixels as pasting img onto a transparent card through the mask,
+    # without a second card-sized image
+    for box, mask in plan:
+        if mask is None:
+            img.paste((0, 0, 0, 0), box)
+        else:
+            region = img.crop(box)
+            clear = Image.new(img.mode, region.size)
+            clear.paste(region, (0, 0), mask)
+            img.paste(clear, box)
+
+def px(value, scale=1.0):
+    # a length (or tuple of lengths) in master pixels at another resolution;
+    # untouched at scale 1, so master renders stay exactly as they were
+    if scale == 1:
+        return value
+    if isinstance(value, tuple):
+        return tuple(px(v, scale) for v in value)
+    return int(round(value * scale))
 
-    thick_arc((rx1, ry1, rx1+r, ry1+r), (rx1+r, ry1+r))
-    thick_arc((rx2-r, ry1, rx2, ry1+r), (rx2-r, ry1+r))
-    thick_arc((rx1, ry2-r, rx1+r, ry2), (rx1+r, ry2-r))
-    thick_arc((rx2-r, ry2-r, rx2, ry2), (rx2-r, ry2-r))
+def card_box(w, h, scale=1.0):
+    # a w x h box (master pixels) centered on the card, at scale
+    return ((W/2 - w/2) * scale, (H/2 - h/2) * scale,
+            (W/2 + w/2) * scale, (H/2 + h/2) * scale)
+
+def draw_rounded_rect(img, bbox, r, color, thickness, supersample=1):
+    img.paste(color, (0, 0), cached_mask(img.size, bbox, r, thickness,
+                                         supersample))
+
+def _blank_card(guides, supersample, scale=1.0):
+    img = Image.new("RGBA", (int(W * scale), int(H * scale)), "white")
+    if "C" in guides:
+        draw_rounded_rect(img, card_box(CUT_W, CUT_H, scale), px(50, scale),
+                          "black", max(px(10, scale), 1), supersample)
+    if "S" in guides:
+        draw_rounded_rect(img, card_box(SAFE_W, SAFE_H, scale), px(40, scale),
+                          "red", max(px(2, scale), 1), supersample)
+    return img
 
 
 class Card(object):
-    def __init__(self, guides=""):
-        self.img = Image.new("RGBA", (int(W),int(H)), "white")
-
-        draw = ImageDraw.Draw(self.img)
-        if "C" in guides:
-            ul = (W/2 - CUT_W/2, H/2 - CUT_H/2)
-            br = (W/2 + CUT_W/2, H/2 + CUT_H/2)
-            draw_rounded_rect(self.img, ul+br, 50, "black", 10)
-        if "S" in guides:
-            ul = (W/2 - SAFE_W/2, H/2 - SAFE_H/2)
-            br = (W/2 + SAFE_W/2, H/2 + SAFE_H/2)
-            draw_rounded_rect(self.img, ul+br, 40, "red", 2)
+    def __init__(self, guides="", supersample=1, deferred=False, scale=1.0):
+        # supersample=1 reproduces the original aliased outlines exactly.
+        # deferred cards collect pastes as layers and blend them all at
+        # once when the image is next needed, see flush. scale renders the
+        # card at another resolution; W, H and friends stay in master pixels.
+        self.supersample = supersample
+        self.scale = scale
+        self.layers = [] if deferred else None
+        guides = ("C" if "C" in guides else "") + ("S" if "S" in guides else "")
+        key = ("base", (W, H, CUT_W, CUT_H, SAFE_W, SAFE_H), guides,
+               supersample, scale)
+        base = MASK_CACHE.get(key, lambda: _blank_card(guides, supersample,
+                                                       scale))
+        self._img = POOL.acquire("RGBA", base.size, None)
+        self._img.paste(base, (0, 0))
+        # until someone draws on img directly, flush can start from a shared
+        # array of the blank card instead of converting the image
+        self._base = key if deferred else None
 
-    def cut_mask(self):
-        ul = (W/2 - CUT_W/2, H/2 - CUT_H/2)
-        br = (W/2 + CUT_W/2, H/2 + CUT_H/2)
-        mask = Image.new("RGBA", self.img.size)
-        draw_rounded_rect(mask, ul+br, 50, "black", int(CUT_W - 1))
-        return mask
+    @classmethod
+    def from_image(cls, img, supersample=1, scale=1.0):
+        card = cls.__new__(cls)
+        card.supersample = supersample
+        card.scale = scale
+        card.layers = card._base = None
+        card._img = img
+        return card
 
-    def size(self):
-        return self.img.size
+    def copy(self):
+        # an independent card with the same pixels and pending layers
+        card = Card.from_image(POOL.acquire("RGBA", self._img.size, None),
+                               self.supersample, self.scale)
+        card._img.paste(self._img, (0, 0))
+        card.layers = list(self.layers) if self.layers is not None else None
+        card._base = self._base
+        return card
 
-    def draw_back(self, color="#ea3944"): # red
-        ul = (W/2 - SAFE_W/2, H/2 - SAFE_H/2)
-        br = (W/2 + SAFE_W/2, H/2 + SAFE_H/2)
-        mask = Image.new("RGBA", self.img.size)
-        draw_rounded_rect(mask, ul+br, 40, "black", int(SAFE_W - 1))
+    @property
+    def img(self):
+        # drawing straight onto the image must see the pending layers
+        self.flush()
+        self._base = None
+        return self._img
 
-        pattern = Image.new("RGBA", self.img.size)
-        draw = ImageDraw.Draw(pattern)
-        draw.rectangle((0,0) + pattern.size, fill=color)
+    @img.setter
+    def img(self, img):
+        # the old image goes back to the pool, so don't keep using it
+        if self.layers:
+            self.layers = []
+        self._base = None
+        if img is not self._img:
+            POOL.release(self._img)
+        self._img = img
 
-        suits = Image.open("images/suits.png")
-        suits = suits.resize((256, 64), Image.ANTIALIAS)
+    @traced("Card.flush")
+    def flush(self, cut=False):
+        # with cut, also clears everything outside the cut line; the card
+        # image is then final, as returned by render_job
+        if not self.layers and not cut:
+            return self._img
+        if not self.layers and self._base is None:
+            # nothing to blend, so the cut can be done in place
+            plan = MASK_CACHE.get(("cut",) + self._cut_args(),
+                                  lambda: cut_plan(self.cut_mask()))
+            cut_in_place(self._img, plan)
+            return self._img
+        mask = self.cut_mask() if cut else None
+        base = self._img
+        if self._base is not None:
+            base = MASK_CACHE.get(("array",) + self._base,
+                                  lambda: np.asarray(self._img))
+        # blended in scratch arrays and written back into the pooled canvas,
+        # like the paste path, rather than into a fresh image per card
+        composite(base, self.layers or (), mask, out=self._img)
+        self._base = None
+        if self.layers:
+            self.layers = []
+        return self._img
 
-        # # hatched pattern
-        # draw.rectangle((0,0) + pattern.size, fill="#ddcb8d")
-        # for x in range(pattern.size[0]):
-        #     for y in range(pattern.size[1]):
-        #         a, b = (x + y), (x - y)
-        #         if (a % 70) <= 9 or (b % 70) <= 9:
-        #             draw.point((x, y), "#9e8634")
+    @traced("Card.cut_mask")
+    def cut_mask(self):
+        # shared between cards; use it as a paste mask, don't draw on it
+        return cached_mask(*self._cut_args())
+
+    def _cut_args(self):
+        return (self._img.size, card_box(CUT_W, CUT_H, self.scale),
+                px(50, self.scale), int(CUT_W * self.scale - 1),
+                self.supersample)
 
-        self.img.paste(pattern, (0, 0), mask)
-        self.paste(suits, int(W/2), int(H/4))
-        self.paste(suits.transpose(Image.ROTATE_180), int(W/2), int(3*H/4))
+    def size(self):
+        return self._img.size
 
+    @traced("Card.draw_back")
+    def draw_back(self, color="#ea3944", stripe=None, ink=None): # red
+        # stripe hatches the back in a second color (e.g. variants.HATCH_COLORS)
+        # and ink recolors the suits; see variants.py
+        from variants import back_template
+        template = back_template(self.scale, self.supersample,
+                                 stripe is not None)
+        self.img = template.render(self.img, color, stripe, ink)
 
     def _paste(self, icon, x, y):
         w, h = icon.size
+        if self.layers is not None and icon.mode == "RGBA":
+            self.layers.append((icon, x, y))
+            return
         # use icon as mask for itself
         self.img.paste(icon, (x, y, x + w, y + h), icon)
 
@@ -87,6 +250,11 @@ class Card(object):
         w, h = icon.size
         self._paste(icon, x - w/2, y - h/2)
 
+    def paste_layer(self, pastes):
+        # pastes is a list of (icon, left, top), e.g. pips.PipLayer.pastes
+        for icon, x, y in pastes:
+            self._paste(icon, x, y)
+
     def pasten(self, icon, positions):
         w, h = icon.size
         for x, y in positions:
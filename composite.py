@@ -0,0 +1,118 @@
+import threading
+import numpy as np
+from PIL import Image
+from cache import LRUCache
+
+# Blends a stack of RGBA sprites into a card in numpy, with the same integer
+# arithmetic as PIL's masked paste (img.paste(icon, box, icon)), so the result
+# is pixel-identical to pasting the layers one by one. It is not faster: the
+# numpy blend makes several passes over each sprite where PIL's paste makes
+# one, and cards render 2-3x slower this way (bench.py's *_composite stages).
+
+# Sprites come from the asset store and corner atlas, so the same few images
+# are pasted over and over. Entries keep a reference to their sprite (or
+# mask), which keeps its id from being reused while the entry is alive.
+PREPARED = LRUCache(maxsize=256)
+
+# per-thread scratch arrays, grown to the largest card seen, so blending a
+# card into a pooled canvas allocates nothing once the thread has done one
+_SCRATCH = threading.local()
+
+def _scratch(name, dtype, shape):
+    n = int(np.prod(shape))
+    flat = getattr(_SCRATCH, name, None)
+    if flat is None or flat.size < n:
+        flat = np.empty(n, dtype)
+        setattr(_SCRATCH, name, flat)
+    return flat[:n].reshape(shape)
+
+def _div255(x):
+    # PIL's DIV255 in place: exact rounding of x / 255 for x <= 255 * 255,
+    # which also keeps every step within uint16
+    x += 128
+    x += x >> 8
+    x >>= 8
+    return x
+
+def _prepare(sprite):
+    arr = np.asarray(sprite)
+    alpha = arr[:, :, 3]
+    ys, xs = np.nonzero(alpha)
+    if not len(ys):
+        return sprite, None, None, None
+    # fully transparent pixels leave the card alone, so crop them away
+    y1, y2, x1, x2 = ys.min(), ys.max() + 1, xs.min(), xs.max() + 1
+    a = alpha[y1:y2, x1:x2, None].astype(np.uint16)
+    src = arr[y1:y2, x1:x2] * a
+    return sprite, (x1, y1, x2, y2), src, 255 - a
+
+def blend(buf, sprite, x, y):
+    # buf is an h x w x 4 uint8 array; x, y is the sprite's top left corner
+    _, box, src, inv = PREPARED.get(id(sprite), lambda: _prepare(sprite))
+    if box is None:
+        return
+    h, w = buf.shape[:2]
+    x1, y1 = x + box[0], y + box[1]
+    x2, y2 = x + box[2], y + box[3]
+    # clip to the card, like PIL does
+    cx1, cy1, cx2, cy2 = max(x1, 0), max(y1, 0), min(x2, w), min(y2, h)
+    if cx1 >= cx2 or cy1 >= cy2:
+        return
+    sx, sy = cx1 - x1, cy1 - y1
+    src = src[sy:sy + cy2 - cy1, sx:sx + cx2 - cx1]
+    inv = inv[sy:sy + cy2 - cy1, sx:sx + cx2 - cx1]
+    region = buf[cy1:cy2, cx1:cx2]
+    out = np.multiply(region, inv, _scratch("blend", np.uint16, region.shape))
+    out += src
+    region[...] = _div255(out)
+
+def _mask_spans(mask):
+    # a 0/255 mask that is one run of 255 per row (like the rounded cut)
+    # reduces to (y1, y2, left, right) bands of identical rows
+    m = np.asarray(mask)
+    if ((m > 0) & (m < 255)).any():
+        return mask, None
+    spans = []
+    for y, row in enumerate(m):
+        xs = np.flatnonzero(row)
+        l, r = (xs[0], xs[-1] + 1) if len(xs) else (0, 0)
+        if r - l != len(xs):
+            return mask, None
+        if spans and spans[-1][2:] == (l, r):
+            spans[-1] = (spans[-1][0], y + 1, l, r)
+        else:
+            spans.append((y, y + 1, l, r))
+    return mask, spans
+
+def apply_mask(buf, mask):
+    # same as pasting buf onto a transparent image through an "L" mask
+    _, spans = PREPARED.get(("mask", id(mask)), lambda: _mask_spans(mask))
+    if spans is None:
+        out = buf * np.asarray(mask)[:, :, None].astype(np.uint16)
+        buf[...] = _div255(out)
+        return
+    for y1, y2, l, r in spans:
+        buf[y1:y2, :l] = 0
+        buf[y1:y2, r:] = 0
+
+def composite(base, layers, mask=None, out=None):
+    # base is an RGBA image (or its array), layers a list of (sprite, x, y)
+    # in paste order; sprites must be RGBA too, since their alpha is the
+    # paste mask. With out, an RGBA image of base's size (a pooled canvas,
+    # say), the result is written into out instead of a new image.
+    if out is None:
+        buf = np.array(base)
+    else:
+        base = np.asarray(base)
+        buf = _scratch("card", np.uint8, base.shape)
+        np.copyto(buf, base)
+    for sprite, x, y in layers:
+        blend(buf, sprite, x, y)
+    if mask is not None:
+        apply_mask(buf, mask)
+    if out is None:
+        return Image.fromarray(buf, "RGBA")
+    # paste rather than frombytes, which would write through a read-only
+    # image into whatever memory it maps
+    out.paste(Image.fromarray(buf, "RGBA"), (0, 0))
+    return out
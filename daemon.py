@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+
+# A long-lived render server that keeps fonts, the CardMaker and resized
+# art warm between requests, listening on a Unix domain socket.
+#
+#   python daemon.py serve --socket /tmp/tichu.sock --workers 4
+#   python daemon.py render "gem Q" --guides CS -o gemQ.png
+#   python daemon.py metrics
+#
+# Protocol: the client sends one JSON line, e.g.
+#   {"card": "gem Q", "guides": "CS", "format": "png"}
+# optionally with "output": "/some/path" to have the server write the file.
+# The server answers with one JSON line; on success without "output" it is
+# followed by "size" bytes of the encoded image. {"cmd": "metrics"} returns
+# request counts and latency percentiles instead.
+
+import os, sys, io, json, time, threading, argparse
+from collections import deque
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import socket
+from make_deck import (CardMaker, load_jobs, render_job, normalize_card_name,
+                       asset_manifest)
+from deckspec import load_spec
+from puzzle_cards import default_resources
+from preload import Preloader
+from buffers import POOL
+from output import write_atomic
+
+DEFAULT_SOCKET = "/tmp/tichu-cards.sock"
+
+
+class RenderDaemon(object):
+    def __init__(self, socket_path=DEFAULT_SOCKET, workers=4, queue_size=64,
+                 deck_spec=None):
+        self.socket_path = socket_path
+        self.queue = queue.Queue(queue_size)
+        self.started = time.time()
+        self.latencies = deque(maxlen=10000) # seconds, most recent requests
+        self.counts = {"ok": 0, "error": 0}
+        self._lock = threading.Lock()
+
+        # the cards of deck_spec's deck (deck.json by default), named by its
+        # suits
+        self.spec = load_spec(deck_spec)
+        jobs = load_jobs(deck_spec)
+        self.jobs = dict((job.name, job) for job in jobs)
+
+        # everything expensive happens once, here; the art loads in the
+        # background, and a request for a card whose art is still loading
+        # waits for just that
+        self.cm = CardMaker()
+        self.preloader = Preloader()
+        self.preloader.start(asset_manifest(jobs, self.cm))
+        default_resources()
+        # the corner sprites, and the glyph sheets they are cut from, are
+        # built on first use without a lock; build them all before there
+        # are workers to race on them
+        for num, suit in self.cm.corners.keys():
+            self.cm.corners.get(num, suit)
+
+        self.workers = []
+        for _ in range(workers):
+            t = threading.Thread(target=self._work)
+            t.daemon = True
+            t.start()
+            self.workers.append(t)
+
+    def submit(self, request):
+        # blocks while the queue is full, then until the card is done
+        done = {"event": threading.Event(), "start": time.time()}
+        self.queue.put((request, done))
+        done["event"].wait()
+        return done["result"]
+
+    def _work(self):
+        while True:
+            request, done = self.queue.get()
+            try:
+                result = self._render(request)
+                ok = True
+            except Exception as e:
+                result = ({"ok": False, "error": "%s: %s" % (type(e).__name__, e)},
+                          None)
+                ok = False
+            with self._lock:
+                self.latencies.append(time.time() - done["start"])
+                self.counts["ok" if ok else "error"] += 1
+            done["result"] = result
+            done["event"].set()
+
+    def _render(self, request):
+        name = normalize_card_name(request["card"], self.spec)
+        if name not in self.jobs:
+            raise KeyError("unknown card %r" % request["card"])
+        fmt = request.get("format", "png").upper()
+        img = render_job(self.cm, self.jobs[name], request.get("guides", ""))
+
+        data = io.BytesIO()
+        img.save(data, fmt)
+        data = data.getvalue()
+        POOL.release(img)
+        output = request.get("output")
+        if output:
+            write_atomic(output, data)
+            return {"ok": True, "card": name, "path": os.path.abspath(output)}, None
+        return {"ok": True, "card": name, "format": fmt.lower(),
+                "size": len(data)}, data
+
+    def metrics(self):
+        with self._lock:
+            latencies = sorted(self.latencies)
+            counts = dict(self.counts)
+        def pct(p):
+            if not latencies:
+                return None
+            return latencies[min(len(latencies) - 1, int(p / 100.0 * len(latencies)))]
+        return {"ok": True, "requests": counts, "queued": self.queue.qsize(),
+                "workers": len(self.workers),
+                "uptime": time.time() - self.started,
+                "latency_ms": dict(("p%d" % p, None if pct(p) is None else pct(p) * 1000)
+                                   for p in (50, 90, 99)),
+                "window": len(latencies)}
+
+    def serve_forever(self):
+        daemon = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                line = self.rfile.readline()
+                if not line:
+                    return
+                try:
+                    request = json.loads(line.decode("utf-8"))
+                except ValueError as e:
+                    header, data = {"ok": False, "error": "bad request: %s" % e}, None
+                else:
+                    if request.get("cmd") == "metrics":
+                        header, data = daemon.metrics(), None
+                    elif request.get("cmd") == "ping":
+                        header, data = {"ok": True}, None
+                    else:
+                        header, data = daemon.submit(request)
+                self.wfile.write((json.dumps(header) + "\n").encode("utf-8"))
+                if data is not None:
+                    self.wfile.write(data)
+
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        server = socketserver.ThreadingUnixStreamServer(self.socket_path, Handler)
+        server.daemon_threads = True
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+            os.unlink(self.socket_path)
+
+
+def request(socket_path=DEFAULT_SOCKET, **req):
+    # client side: returns (header dict, image bytes or None)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(socket_path)
+    try:
+        f = sock.makefile("rwb")
+        f.write((json.dumps(req) + "\n").encode("utf-8"))
+        f.flush()
+        header = json.loads(f.readline().decode("utf-8"))
+        data = f.read(header["size"]) if header.get("size") else None
+        f.close()
+    finally:
+        sock.close()
+    return header, data
+
+def main():
+    parser = argparse.ArgumentParser(description="Card render daemon.")
+    parser.add_argument("--socket", default=DEFAULT_SOCKET)
+    sub = parser.add_subparsers(dest="command")
+
+    serve = sub.add_parser("serve")
+    serve.add_argument("--workers", type=int, default=4)
+    serve.add_argument("--queue-size", type=int, default=64)
+    serve.add_argument("--deck-spec", default=None,
+                       help="JSON deck spec to serve (default: deck.json)")
+
+    render = sub.add_parser("render")
+    render.add_argument("card")
+    render.add_argument("--guides", default="")
+    render.add_argument("--format", default="png")
+    render.add_argument("-o", "--output", help="file to write the card to")
+
+    sub.add_parser("metrics")
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        RenderDaemon(args.socket, args.workers, args.queue_size,
+                     args.deck_spec).serve_forever()
+    elif args.command == "render":
+        header, data = request(args.socket, card=args.card, guides=args.guides,
+                               format=args.format)
+        if not header["ok"]:
+            sys.exit(header["error"])
+        output = args.output or "%s.%s" % (header["card"], args.format)
+        f = open(output, "wb")
+        f.write(data)
+        f.close()
+        print(output)
+    elif args.command == "metrics":
+        header, _ = request(args.socket, cmd="metrics")
+        print(json.dumps(header, indent=2, sort_keys=True))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+import os, json
+
+# What the deck contains and where each card sits on the sheet, read from a
+# JSON spec (deck.json) instead of being spelled out in code. Cards are
+# listed in deck order; each one takes the next free column of its row.
+#
+#   {"kind": "back", "name": "back", "row": 0, "color": "#ea3944"}
+#   {"kind": "special", "name": "dog", "row": 0, "value": "O",
+#    "art": "images/dog.png", "size": [640, 480]}
+#   {"kind": "text", "name": "teachus", "row": 0}
+#   {"kind": "rounds", "name": "round%d", "row": 0} # one per puzzle round
+#   {"kind": "suit", "suit": "gem", "row": 4, "faces": [J, Q, K]}
+#
+# A suit expands to A-10 and the three face cards, each face being
+# {"art": ..., "size": [w, h], "offset": [dx, dy]} in master pixels. An
+# optional "tilt" slopes the suit's pip rows, see GridMaker.tilt.
+# "variants" lists the renders a single run can make of the whole deck,
+# see renderplan.py.
+
+SPEC_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         "deck.json")
+SPEC_VERSION = 1
+
+_specs = {}
+
+
+class CardJob(object):
+    # one card of the deck: output name, (col, row) slot on the sheet and
+    # what to render
+    def __init__(self, name, slot, kind, args=()):
+        self.name = name
+        self.slot = slot
+        self.kind = kind
+        self.args = tuple(args)
+
+
+class Variant(object):
+    # one way of rendering the deck: guides drawn, whether it is cut to the
+    # rounded corners, and optionally another back (color, stripe, ink)
+    def __init__(self, name="", guides="", cut=True, back=None):
+        self.name = name
+        self.guides = guides
+        self.cut = cut
+        self.back = tuple(back) if back is not None else None
+
+
+def load_spec(path=None):
+    # path is the deck spec's file, deck.json by default
+    path = path or SPEC_PATH
+    if path not in _specs:
+        f = open(path, "r")
+        spec = json.loads(f.read())
+        f.close()
+        if spec.get("version") != SPEC_VERSION:
+            raise ValueError("%s: unsupported deck spec version %r" % (
+                path, spec.get("version")))
+        _specs[path] = spec
+    return _specs[path]
+
+def suit_names(spec=None):
+    return list((spec or load_spec())["suits"])
+
+def special_art(spec=None):
+    # value -> (art, size)
+    return dict((card["value"], (card["art"], tuple(card["size"])))
+                for card in (spec or load_spec())["cards"]
+                if card["kind"] == "special")
+
+def face_art(spec=None):
+    # per suit index: J, Q, K as (art, size, offset)
+    spec = spec or load_spec()
+    faces = dict((card["suit"], card["faces"]) for card in spec["cards"]
+                 if card["kind"] == "suit")
+    return [[(face["art"], tuple(face["size"]), tuple(face["offset"]))
+             for face in faces[suit]] for suit in spec["suits"]]
+
+def spec_variants(spec=None):
+    return [Variant(v["name"], v.get("guides", ""), v.get("cut", True),
+                    v.get("back"))
+            for v in (spec or load_spec()).get("variants", [])]
+
+def deck_jobs(puzzle_data, spec=None):
+    spec = spec or load_spec()
+    suits = spec["suits"]
+    jobs = []
+    cols = {}
+
+    def add(name, row, kind, args=()):
+        col = cols.get(row, 0)
+        cols[row] = col + 1
+        jobs.append(CardJob(name, (col, row), kind, args))
+
+    for card in spec["cards"]:
+        kind, row = card["kind"], card["row"]
+        if kind == "back":
+            add(card["name"], row, "back", (card.get("color", "#ea3944"),
+                                            card.get("stripe"),
+                                            card.get("ink")))
+        elif kind == "special":
+            add(card["name"], row, "special",
+                (card["value"], card["art"], tuple(card["size"])))
+        elif kind == "text":
+            add(card["name"], row, "text")
+        elif kind == "rounds":
+            for idx, (codes, tricks, scores) in enumerate(puzzle_data):
+                add(card["name"] % (idx + 1), row, "round",
+                    (idx + 1, codes, tricks, scores))
+        elif kind == "suit":
+            suit = suits.index(card["suit"])
+            tilt = (card["tilt"],) if card.get("tilt") is not None else ()
+            for num in range(1, 11):
+                add(card["suit"] + ("A" if num == 1 else str(num)), row,
+                    "card", (num, suit) + tilt)
+            for num, face in enumerate(card["faces"], 11):
+                add(card["suit"] + str(num), row, "face",
+                    (num, suit, face["art"], tuple(face["size"]),
+                     tuple(face["offset"])))
+        else:
+            raise ValueError("unknown card kind %r in the deck spec" % kind)
+    return jobs
@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+
+# Golden-image regression checks: record a hash of every rendered card, and
+# of each 128px tile of it to say where a change is, then verify a later
+# render against them.
+#
+#   python golden.py record golden.json --refs golden
+#   ... refactor ...
+#   python golden.py verify golden.json --refs golden --diffs diffs
+#
+# verify exits with status 1 if any card differs. With --refs, record also
+# keeps the cards as PNGs, so verify can report the largest per-pixel
+# difference and write a reference | current | difference image for each
+# tile that changed. Only cards that differ are ever decoded.
+
+import os, sys, json, time, hashlib, argparse
+import numpy as np
+from PIL import Image
+
+from output import encode, write_atomic
+from buffers import POOL
+from deckspec import load_spec
+
+INDEX_VERSION = 1
+TILE = 128
+
+def card_key(name, guides="", scale=1.0, cut=True):
+    # cards are recorded per set of the parameters that change their pixels;
+    # composite isn't one of them, it has to match the PIL path exactly
+    return "%s guides=%s scale=%g cut=%d" % (name, guides, scale, cut)
+
+def _tiles(size, tile):
+    # (x, y, w, h) of each tile, row by row
+    w, h = size
+    return [(x, y, min(tile, w - x), min(tile, h - y))
+            for y in range(0, h, tile) for x in range(0, w, tile)]
+
+def hash_card(img, tile=TILE):
+    data = img.tobytes()
+    pixels = np.frombuffer(data, np.uint8).reshape(
+        img.size[1], img.size[0], -1)
+    tiles = [hashlib.sha1(pixels[y:y+h, x:x+w].tobytes()).hexdigest()[:16]
+             for x, y, w, h in _tiles(img.size, tile)]
+    return {"mode": img.mode, "size": list(img.size),
+            "hash": hashlib.sha1(data).hexdigest(), "tiles": tiles}
+
+
+class Mismatch(object):
+    def __init__(self, key, reason, tiles=(), max_delta=None):
+        # tiles are the (x, y, w, h) boxes that changed; max_delta is the
+        # largest channel difference in them, if there was a reference
+        self.key = key
+        self.reason = reason
+        self.tiles = list(tiles)
+        self.max_delta = max_delta
+
+    def __str__(self):
+        ret = "%s: %s" % (self.key, self.reason)
+        if self.tiles:
+            ret += ", %d tiles at %s" % (len(self.tiles), " ".join(
+                "%d,%d" % (x, y) for x, y, _, _ in self.tiles[:8]))
+            if len(self.tiles) > 8:
+                ret += " ..."
+        if self.max_delta is not None:
+            ret += ", max delta %d" % self.max_delta
+        return ret
+
+
+class GoldenIndex(object):
+    def __init__(self, path, refs=None, tile=TILE):
+        self.path = path
+        self.refs = refs
+        self.tile = tile
+        self.cards = {}
+        if os.path.exists(path):
+            f = open(path, "r")
+            index = json.loads(f.read())
+            f.close()
+            if index.get("version") == INDEX_VERSION:
+                self.tile = index["tile"]
+                self.cards = index["cards"]
+
+    def _ref_path(self, entry):
+        # named by content, so identical cards share a reference
+        return os.path.join(self.refs, entry["hash"] + ".png")
+
+    def record(self, key, img):
+        entry = hash_card(img, self.tile)
+        self.cards[key] = entry
+        if self.refs is not None:
+            path = self._ref_path(entry)
+            if not os.path.exists(path):
+                write_atomic(path, encode(img, "png", 1))
+        return entry
+
+    def verify(self, key, img, diffs=None):
+        # None if img matches what was recorded for key
+        if key not in self.cards:
+            return Mismatch(key, "not in the index")
+        golden = self.cards[key]
+        if golden["mode"] != img.mode or tuple(golden["size"]) != img.size:
+            return Mismatch(key, "was %s %dx%d, now %s %dx%d" % (
+                golden["mode"], golden["size"][0], golden["size"][1],
+                img.mode, img.size[0], img.size[1]))
+        entry = hash_card(img, self.tile)
+        if entry["hash"] == golden["hash"]:
+            return None
+
+        tiles = [box for box, old, new in zip(_tiles(img.size, self.tile),
+                                              golden["tiles"], entry["tiles"])
+                 if old != new]
+        if self.refs is None or not os.path.exists(self._ref_path(golden)):
+            return Mismatch(key, "pixels differ", tiles)
+
+        ref = Image.open(self._ref_path(golden))
+        max_delta = 0
+        for x, y, w, h in tiles:
+            box = (x, y, x + w, y + h)
+            old = np.asarray(ref.crop(box), np.int16)
+            new = np.asarray(img.crop(box), np.int16)
+            delta = np.abs(new - old).max(axis=2)
+            max_delta = max(max_delta, int(delta.max()))
+            if diffs is not None:
+                self._write_diff(diffs, key, (x, y), ref.crop(box),
+                                 img.crop(box), delta)
+        return Mismatch(key, "pixels differ", tiles, max_delta)
+
+    def _write_diff(self, diffs, key, (x, y), old, new, delta):
+        # reference, current and the difference (amplified 8x) side by side
+        w, h = old.size
+        out = Image.new("RGBA", (3 * w, h), "white")
+        out.paste(old, (0, 0))
+        out.paste(new, (w, 0))
+        out.paste(Image.fromarray(
+            np.minimum(delta * 8, 255).astype(np.uint8), "L"), (2 * w, 0))
+        name = "%s_%d_%d.png" % (key.split(" ")[0], x, y)
+        out.save(os.path.join(diffs, name))
+
+    def save(self):
+        index = {"version": INDEX_VERSION, "tile": self.tile,
+                 "cards": self.cards}
+        write_atomic(self.path, json.dumps(index, sort_keys=True,
+                                           separators=(",", ":")))
+
+
+def run(mode, path, refs=None, diffs=None, cards=None, guides="", scale=1.0,
+        workers=1, composite=False, deck_spec=None):
+    # renders the deck of deck_spec (or the cards matching cards, see
+    # make_deck.select_jobs) and records or verifies it; returns the
+    # mismatches
+    from make_deck import load_jobs, select_jobs, render_jobs
+    jobs = load_jobs(deck_spec)
+    if cards is not None:
+        jobs = select_jobs(jobs, cards, load_spec(deck_spec))
+    for dirname in (refs, diffs):
+        if dirname is not None and not os.path.exists(dirname):
+            os.makedirs(dirname)
+
+    index = GoldenIndex(path, refs)
+    mismatches = []
+    for job, img in render_jobs(jobs, guides, workers, composite,
+                                scale=scale):
+        key = card_key(job.name, guides, scale)
+        if mode == "record":
+            index.record(key, img)
+        else:
+            mismatch = index.verify(key, img, diffs)
+            if mismatch is not None:
+                mismatches.append(mismatch)
+        POOL.release(img)
+    if mode == "record":
+        index.save()
+    return mismatches
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Record or verify card renders against golden hashes.")
+    parser.add_argument("mode", choices=["record", "verify"])
+    parser.add_argument("index", help="the JSON hash index")
+    parser.add_argument("--refs", default=None,
+                        help="directory of reference PNGs, for diffs")
+    parser.add_argument("--diffs", default=None,
+                        help="write an image of each changed tile here")
+    parser.add_argument("--cards", default=None,
+                        help="comma separated card names or globs")
+    parser.add_argument("--guides", default="")
+    parser.add_argument("--scale", type=float, default=1.0)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--deck-spec", default=None,
+                        help="JSON deck spec to render (default: deck.json)")
+    parser.add_argument("--composite", action="store_true",
+                        help="render through the numpy compositor, to check "
+                             "it still matches the paste path")
+    args = parser.parse_args()
+
+    start = time.time()
+    mismatches = run(args.mode, args.index, args.refs, args.diffs,
+                     args.cards,
+                     args.guides, args.scale, args.workers, args.composite,
+                     args.deck_spec)
+    for mismatch in mismatches:
+        print(mismatch)
+    if args.mode == "record":
+        print("recorded in %.1fs" % (time.time() - start))
+    elif mismatches:
+        print("%d card(s) differ (%.1fs)" % (len(mismatches),
+                                             time.time() - start))
+        sys.exit(1)
+    else:
+        print("all cards match (%.1fs)" % (time.time() - start))
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,27 @@
 # -*- coding: utf-8 -*-
 
-import os, sys, math
+import os, sys, math, hashlib
 from PIL import Image, ImageDraw, ImageFont
+from assets import ASSETS, SUITS_PATH
+from cache import LRUCache
+from output import encode, write_atomic
 
+FONT_PATH = "fonts/Acme-Regular.ttf"
+CHINESE_FONT_PATH = "fonts/NotoSerifCJKsc-Bold.otf"
 
 
+# position tables per (dims, margins), shared by every GridMaker; treat
+# them as read-only
+GRIDS = LRUCache(maxsize=8)
+
 class GridMaker(object):
     def __init__(self, dims, margin_w=0, margin_h=0):
         self.W, self.H = dims
         self.margin = (margin_w, margin_h)
-        self.positions = [
+        self.positions = GRIDS.get((tuple(dims), self.margin), self._positions)
+
+    def _positions(self):
+        return [
             None, None,
             self.card_grid(2, 1),
             self.card_grid(3, 1),
@@ -57,75 +69,140 @@ class GridMaker(object):
 
 
 class SuitImages(object):
-    def __init__(self):
-        self.img = Image.open("images/suits.png")
+    def __init__(self, assets=ASSETS):
+        self.assets = assets
+
+    @property
+    def img(self):
+        return self.assets.get(SUITS_PATH)
 
     def _get(self, idx):
-        x = idx * 192
-        return self.img.crop((x, 0, x + 192, 192))
+        return self.assets.get(idx)
 
 class FontImages(object):
-    def __init__(self, visualize=False):
-        self.font = ImageFont.truetype("fonts/Acme-Regular.ttf", 160)
-        self.chinese_font = ImageFont.truetype("fonts/NotoSerifCJKsc-Bold.otf", 144,
-                                               encoding="unic")
+    # numbers_img and specials_img are rendered on first use. With a
+    # cache_dir they are also saved there, keyed by the font file's hash
+    # and the layout below, so a warm start never opens the fonts.
+    VERSION = 1
+    # per sheet: (path, size, encoding) of the font it is drawn with
+    FONTS = {"numbers": (FONT_PATH, 160, ""),
+             "specials": (CHINESE_FONT_PATH, 144, "unic")}
+
+    def __init__(self, visualize=False, cache_dir=None, assets=ASSETS):
+        self.visualize = visualize
+        self.cache_dir = cache_dir
+        self.assets = assets
         self.w, self.h = 120, 120
-        sw, sh = self.special_dims = 140, 150
-
-        self.numbers_img = Image.new("RGBA", (14 * self.w, self.h))
-        self.specials_img = Image.new("RGBA", (4 * sw, sh))
-
-        if visualize:
-            self._visualize()
+        self.special_dims = 140, 150
+        self._numbers_img = self._specials_img = None
+
+    @property
+    def numbers_img(self):
+        if self._numbers_img is None:
+            self._numbers_img = self._cached("numbers", FONT_PATH,
+                                             self._render_numbers)
+        return self._numbers_img
+
+    @property
+    def specials_img(self):
+        if self._specials_img is None:
+            self._specials_img = self._cached("specials", CHINESE_FONT_PATH,
+                                              self._render_specials)
+        return self._specials_img
+
+    def needed_font(self, name):
+        # the font that drawing sheet name ("numbers" or "specials") will
+        # open, or None if the sheet is loaded already or on disk
+        img = self._numbers_img if name == "numbers" else self._specials_img
+        path = self._sheet_path(name, self.FONTS[name][0])
+        if img is None and (path is None or not os.path.exists(path)):
+            return self.FONTS[name]
+        return None
+
+    def _sheet_path(self, name, font_path):
+        if self.cache_dir is None:
+            return None
+        key = repr((self.VERSION, name, self.assets.source_digest(font_path),
+                    self.w, self.h, self.special_dims, self.visualize))
+        return os.path.join(self.cache_dir, "%s-%s.png" % (
+            name, hashlib.sha1(key.encode("utf-8")).hexdigest()))
+
+    def _cached(self, name, font_path, render):
+        if self.cache_dir is None:
+            return render()
+
+        path = self._sheet_path(name, font_path)
+        if os.path.exists(path):
+            img = Image.open(path)
+            img.load()
+            return img
+
+        img = render()
+        if not os.path.isdir(self.cache_dir):
+            try:
+                os.makedirs(self.cache_dir)
+            except OSError:
+                pass
+        write_atomic(path, encode(img, "png"))
+        return img
+
+    def _render_numbers(self):
+        # drawn into a local image: numbers_img only ever sees the whole
+        # sheet, even from another thread or if drawing fails
+        self.font = self.assets.font(*self.FONTS["numbers"])
+        img = Image.new("RGBA", (14 * self.w, self.h))
+        if self.visualize:
+            draw = ImageDraw.Draw(img)
+            for n in range(14):
+                color = "white" if n % 2 == 0 else "#dddddd"
+                draw.rectangle((n*self.w, 0, (n+1)*self.w, self.h), color)
+
+        self._make_numbers(img)
+        return img
+
+    def _render_specials(self):
+        self.chinese_font = self.assets.font(*self.FONTS["specials"])
+        sw, sh = self.special_dims
+        img = Image.new("RGBA", (4 * sw, sh))
+        if self.visualize:
+            draw = ImageDraw.Draw(img)
+            for n in range(4):
+                color = "white" if n % 2 == 0 else "#dddddd"
+                draw.rectangle((n*sw, 0, (n+1)*sw, sh), color)
 
-        self._make_numbers()
         # "龙龍凤鳳犬䲵雀"
         # self._draw_chinese(u"鳳", 0)
         # self._draw_chinese(u"龍", 1)
         # self._draw_chinese(u"犬", 2)
         # self._draw_chinese(u"䲵", 3)
-        self._draw_chinese(u"凤", 0)
-        self._draw_chinese(u"龙", 1)
-        self._draw_chinese(u"犬", 2)
-        self._draw_chinese(u"雀", 3)
-
-
-    def _visualize(self):
-        draw = ImageDraw.Draw(self.numbers_img)
-        for n in range(14):
-            color = "white" if n % 2 == 0 else "#dddddd"
-            draw.rectangle((n*self.w, 0, (n+1)*self.w, self.h), color)
-
-        draw = ImageDraw.Draw(self.specials_img)
-        for n in range(4):
-            color = "white" if n % 2 == 0 else "#dddddd"
-            draw.rectangle((n*self.special_dims[0], 0,
-                            (n+1)*self.special_dims[0], self.special_dims[1]), color)
-
-
-    def _make_numbers(self):
-        draw = ImageDraw.Draw(self.numbers_img)
-        self._draw_letter("A", 1, height_ratio=1.05, adjust=(0, 3))
+        self._draw_chinese(img, u"凤", 0)
+        self._draw_chinese(img, u"龙", 1)
+        self._draw_chinese(img, u"犬", 2)
+        self._draw_chinese(img, u"雀", 3)
+        return img
+
+    def _make_numbers(self, img):
+        self._draw_letter(img, "A", 1, height_ratio=1.05, adjust=(0, 3))
         for n in range(2, 10):
-            self._draw_single_digit(str(n), n)
+            self._draw_single_digit(img, str(n), n)
 
         # make 10 thinner
         thin_ten = self._make_ten().resize((self.w, self.h), Image.ANTIALIAS)
-        self.numbers_img.paste(thin_ten, (10*self.w + 14, 0), thin_ten)
+        img.paste(thin_ten, (10*self.w + 14, 0), thin_ten)
 
-        self._draw_letter("J", 11, height_ratio=1.05, adjust=(0, 3))
-        self._draw_letter("Q", 12, height_ratio=1.16, adjust=(0, 3))
-        self._draw_letter("K", 13, height_ratio=1.05, adjust=(0, 3))
+        self._draw_letter(img, "J", 11, height_ratio=1.05, adjust=(0, 3))
+        self._draw_letter(img, "Q", 12, height_ratio=1.16, adjust=(0, 3))
+        self._draw_letter(img, "K", 13, height_ratio=1.05, adjust=(0, 3))
 
-    def _draw_single_digit(self, t, position):
-        draw = ImageDraw.Draw(self.numbers_img)
+    def _draw_single_digit(self, img, t, position):
+        draw = ImageDraw.Draw(img)
         tw, th = draw.textsize(t, font=self.font)
         x = position * self.w
         draw.text((int(x + self.w/2.0 - tw/2.0),
                    int(self.h/2.0 - th/2.0 - 24)),
                   t, font=self.font, fill="black")
 
-    def _draw_letter(self, t, position, height_ratio=1.0, adjust=(0, 0)):
+    def _draw_letter(self, img, t, position, height_ratio=1.0, adjust=(0, 0)):
         lw, lh = self.w, int(height_ratio * self.h)
         letter_img = Image.new("RGBA", (lw, lh))
         draw = ImageDraw.Draw(letter_img)
@@ -135,7 +212,7 @@ class FontImages(object):
                   t, font=self.font, fill="black")
 
         letter_img = letter_img.resize((self.w, self.h))
-        self.numbers_img.paste(
+        img.paste(
             letter_img, (position * self.w + adjust[0], adjust[1]), letter_img)
 
     def _make_ten(self):
@@ -153,8 +230,8 @@ class FontImages(object):
         draw.text((left + tw1 - shaved, top), "0", font=self.font, fill="black")
         return ten_img
 
-    def _draw_chinese(self, t, position):
-        draw = ImageDraw.Draw(self.specials_img)
+    def _draw_chinese(self, img, t, position):
+        draw = ImageDraw.Draw(img)
         sw, sh = self.special_dims
         tw, th = draw.textsize(t, font=self.chinese_font)
         x = position * sw
@@ -178,6 +255,107 @@ class FontImages(object):
         return self.numbers_img.crop((x, 0, x+self.w, self.h))
 
 
+class CornerAtlas(object):
+    # Corner index sprites (rank glyph over a small suit), upright and
+    # rotated 180, for every (num, suit) in the deck. The specials P, D, O
+    # and M have no suit. Sprites are shared; don't draw on them.
+    #
+    # With a cache_dir the complete set is kept there as one sheet: loaded
+    # on first use if present, written once every sprite has been built.
+    # At a scale other than 1 each sprite is drawn at MW x MH and resized.
+    VERSION = 1
+    MW, MH = 130, 300
+
+    def __init__(self, font_imgs, assets=ASSETS, cache_dir=None, scale=1.0):
+        self.font_imgs = font_imgs
+        self.assets = assets
+        self.cache_dir = cache_dir
+        self.scale = scale
+        self.mw, self.mh = self.MW, self.MH
+        if scale != 1:
+            self.mw, self.mh = (int(round(self.MW * scale)),
+                                int(round(self.MH * scale)))
+        self.sprites = {}
+        self._path = None
+        self._tried_load = False
+
+    def cache_path(self):
+        if self.cache_dir is None:
+            return None
+        if self._path is None:
+            self._path = os.path.join(self.cache_dir,
+                                      "corners-%s.png" % self.digest())
+        return self._path
+
+    @staticmethod
+    def keys():
+        return ([(num, suit) for suit in range(4) for num in range(1, 14)] +
+                [(value, None) for value in "PDOM"])
+
+    def get(self, num, suit):
+        key = (num, suit)
+        if key not in self.sprites:
+            if not self._tried_load:
+                self._tried_load = True
+                if self.cache_path() is not None and self.load(self.cache_path()):
+                    return self.sprites[key]
+
+            self.sprites[key] = self._build(num, suit)
+            if self.cache_path() is not None and len(self.sprites) == len(self.keys()):
+                self.save(self.cache_path())
+        return self.sprites[key]
+
+    def ready(self):
+        # whether every sprite can be had without drawing any
+        if len(self.sprites) == len(self.keys()):
+            return True
+        return (not self._tried_load and self.cache_path() is not None and
+                os.path.exists(self.cache_path()))
+
+    def _build(self, num, suit):
+        mw, mh = self.MW, self.MH
+        mini = Image.new("RGBA", (mw, mh))
+
+        font_img = self.font_imgs.get_img(num)
+        fw, fh = font_img.size
+        mini.paste(font_img, (mw//2 - fw//2, 0))
+
+        if suit is not None:
+            small = self.assets.get(suit, (120, 120))
+            mini.paste(small, (mw//2 - 60, 132), small)
+        if self.scale != 1:
+            mini = mini.resize((self.mw, self.mh), Image.ANTIALIAS)
+        return mini, mini.transpose(Image.ROTATE_180)
+
+    def digest(self):
+        # everything the sprites are drawn from
+        h = hashlib.sha1(repr((self.VERSION, self.scale)).encode("utf-8"))
+        for path in (SUITS_PATH, FONT_PATH, CHINESE_FONT_PATH):
+            h.update(self.assets.source_digest(path).encode("utf-8"))
+        return h.hexdigest()
+
+    def save(self, path):
+        # one sheet: upright sprites on the top row, rotated below
+        keys = self.keys()
+        sheet = Image.new("RGBA", (len(keys) * self.mw, 2 * self.mh))
+        for idx, key in enumerate(keys):
+            mini, rotated = self.get(*key)
+            sheet.paste(mini, (idx * self.mw, 0))
+            sheet.paste(rotated, (idx * self.mw, self.mh))
+        write_atomic(path, encode(sheet, "png"))
+
+    def load(self, path):
+        if not os.path.exists(path):
+            return False
+        sheet = Image.open(path)
+        sheet.load()
+        for idx, key in enumerate(self.keys()):
+            x = idx * self.mw
+            self.sprites[key] = (sheet.crop((x, 0, x + self.mw, self.mh)),
+                                 sheet.crop((x, self.mh, x + self.mw, 2 * self.mh)))
+        return True
+
+
 
 if __name__ == "__main__":
     fi = FontImages(visualize=True)
@@ -0,0 +1,301 @@
+import zlib
+from PIL import Image
+from card import W, H, CUT_W, CUT_H
+
+# Lays cards out on printer pages and writes them as a PDF, one page at a
+# time. The layout is worked out up front as an ImpositionPlan, which holds
+# only names and coordinates, so it can be inspected (or benchmarked)
+# without rendering anything.
+#
+#   plan = ImpositionPlan(names, PageSpec("letter", 3, 3, duplex="long"))
+#   print(plan.describe())
+#   write_pdf(plan, "deck.pdf", rendered) # rendered: (name, img) in plan.order()
+
+# card images are 300 dpi: the 750px cut line is a 2.5in poker card
+DPI = CUT_W / 2.5
+POINTS = 72.0
+# bleed the card images carry beyond the cut line, in inches
+MAX_BLEED = (W - CUT_W) / 2 / DPI
+
+PAGE_SIZES = {
+    "letter": (8.5, 11.0),
+    "legal": (8.5, 14.0),
+    "a4": (8.27, 11.69),
+    "a3": (11.69, 16.54),
+    # one card per page with its full bleed, like poker-size.pdf
+    "poker": (W / DPI, H / DPI),
+}
+
+# where a page size's PageSpec defaults differ from the usual 3x3 grid with
+# crop marks. A poker page is just the card and its bleed, so there is no
+# room for marks around it.
+PAGE_DEFAULTS = {
+    "poker": {"cols": 1, "rows": 1, "bleed": MAX_BLEED, "crop_marks": False},
+}
+
+
+class PageSpec(object):
+    # all lengths in inches. bleed is how much art to keep beyond the cut
+    # line; cards are spaced so their bleeds don't overlap, plus gutter. With
+    # no bleed and no gutter neighbours share a cut line, which is what lets
+    # a 3x3 grid of poker cards fit on letter.
+    # duplex is None, "long" or "short" (the edge the printer flips on), and
+    # back_offset nudges the back pages to correct the printer's duplex
+    # registration. cols, rows, bleed and crop_marks left as None take the
+    # page's defaults (see PAGE_DEFAULTS).
+    def __init__(self, page="letter", cols=None, rows=None, bleed=None,
+                 gutter=0.0, crop_marks=None, mark_length=0.15,
+                 mark_offset=1/16.0, duplex=None, back_offset=(0.0, 0.0),
+                 back="back"):
+        defaults = {"cols": 3, "rows": 3, "bleed": 0.0, "crop_marks": True}
+        if not isinstance(page, tuple):
+            defaults.update(PAGE_DEFAULTS.get(page, {}))
+            page = PAGE_SIZES[page]
+        if cols is None:
+            cols = defaults["cols"]
+        if rows is None:
+            rows = defaults["rows"]
+        if bleed is None:
+            bleed = defaults["bleed"]
+        if crop_marks is None:
+            crop_marks = defaults["crop_marks"]
+        if not 0 <= bleed <= MAX_BLEED:
+            raise ValueError("bleed must be between 0 and %.3fin" % MAX_BLEED)
+        if duplex not in (None, "long", "short"):
+            raise ValueError("duplex must be None, 'long' or 'short'")
+        self.page = page
+        self.cols, self.rows = cols, rows
+        self.bleed = bleed
+        self.gutter = gutter
+        self.crop_marks = crop_marks
+        self.mark_length = mark_length
+        self.mark_offset = mark_offset
+        self.duplex = duplex
+        self.back_offset = back_offset
+        self.back = back
+
+        # card cell including bleed, and the grid's lower left corner
+        self.cell = (CUT_W / DPI + 2 * bleed, CUT_H / DPI + 2 * bleed)
+        grid_w = cols * self.cell[0] + (cols - 1) * gutter
+        grid_h = rows * self.cell[1] + (rows - 1) * gutter
+        margin = crop_marks and mark_offset + mark_length or 0.0
+        if (grid_w + 2 * margin > page[0] + 1e-9 or
+                grid_h + 2 * margin > page[1] + 1e-9):
+            if (margin and grid_w <= page[0] + 1e-9 and
+                    grid_h <= page[1] + 1e-9):
+                raise ValueError(
+                    "a %dx%d grid leaves no room for crop marks on a %gx%gin "
+                    "page; turn them off or use a smaller bleed" % (
+                        cols, rows, page[0], page[1]))
+            raise ValueError("a %dx%d grid doesn't fit on a %gx%gin page" % (
+                cols, rows, page[0], page[1]))
+        self.origin = ((page[0] - grid_w) / 2, (page[1] - grid_h) / 2)
+        self.grid = (grid_w, grid_h)
+
+    def per_page(self):
+        return self.cols * self.rows
+
+    def slot_box(self, col, row):
+        # (x, y, w, h) of a card cell in inches from the page's lower left;
+        # row 0 is the top row
+        x = self.origin[0] + col * (self.cell[0] + self.gutter)
+        y = (self.origin[1] + self.grid[1] - self.cell[1]
+             - row * (self.cell[1] + self.gutter))
+        return x, y, self.cell[0], self.cell[1]
+
+    def crop_box(self):
+        # the part of a W x H card image that goes on the page, in pixels
+        b = self.bleed * DPI
+        return (int(round((W - CUT_W) / 2 - b)), int(round((H - CUT_H) / 2 - b)),
+                int(round((W + CUT_W) / 2 + b)), int(round((H + CUT_H) / 2 + b)))
+
+    def cut_lines(self):
+        # x and y positions of every cut line on a page, in inches
+        xs, ys = set(), set()
+        for col in range(self.cols):
+            x, y, w, h = self.slot_box(col, 0)
+            xs.update((x + self.bleed, x + w - self.bleed))
+        for row in range(self.rows):
+            x, y, w, h = self.slot_box(0, row)
+            ys.update((y + self.bleed, y + h - self.bleed))
+        return sorted(xs), sorted(ys)
+
+
+class Page(object):
+    def __init__(self, number, side, placements):
+        # placements are (name, (x, y, w, h)) in inches
+        self.number = number
+        self.side = side
+        self.placements = placements
+
+
+class ImpositionPlan(object):
+    def __init__(self, names, spec, decks=1):
+        # names are the card fronts in deck order; with spec.duplex every
+        # front page is followed by a page of backs that lands behind it
+        self.spec = spec
+        self.names = list(names) * decks
+        self.pages = []
+        per_page = spec.per_page()
+        for start in range(0, len(self.names), per_page):
+            slots = []
+            for idx, name in enumerate(self.names[start:start + per_page]):
+                slots.append((name, idx % spec.cols, idx / spec.cols))
+            self._add_page("front", [(name, spec.slot_box(c, r))
+                                     for name, c, r in slots])
+            if spec.duplex:
+                self._add_page("back", [(spec.back, self._back_box(c, r))
+                                        for _, c, r in slots])
+
+    def _add_page(self, side, placements):
+        self.pages.append(Page(len(self.pages) + 1, side, placements))
+
+    def _back_box(self, col, row):
+        spec = self.spec
+        if spec.duplex == "long":
+            col = spec.cols - 1 - col
+        else:
+            row = spec.rows - 1 - row
+        x, y, w, h = spec.slot_box(col, row)
+        return x + spec.back_offset[0], y + spec.back_offset[1], w, h
+
+    def order(self):
+        # distinct card names in the order the PDF first needs them
+        seen, ret = set(), []
+        for page in self.pages:
+            for name, _ in page.placements:
+                if name not in seen:
+                    seen.add(name)
+                    ret.append(name)
+        return ret
+
+    def describe(self):
+        spec = self.spec
+        lines = ["%d cards on %d pages (%gx%gin, %dx%d, bleed %gin%s)" % (
+            len(self.names), len(self.pages), spec.page[0], spec.page[1],
+            spec.cols, spec.rows, spec.bleed,
+            ", duplex %s edge" % spec.duplex if spec.duplex else "")]
+        for page in self.pages:
+            lines.append("  page %d %s: %s" % (
+                page.number, page.side,
+                " ".join(name for name, _ in page.placements)))
+        return "\n".join(lines)
+
+
+class PDFWriter(object):
+    # Just enough PDF for pages of images and lines. Objects go to the file
+    # as soon as they're complete; only their offsets are kept. Object 1 is
+    # the catalog and 2 the page tree, which is written last.
+    def __init__(self, path, compress_level=6):
+        self.compress_level = compress_level
+        self._f = open(path, "wb")
+        self._offsets = {}
+        self._next = 3
+        self._pages = []
+        self._pos = 0
+        self._write("%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+
+    def _write(self, data):
+        self._f.write(data)
+        self._pos += len(data)
+
+    def _object(self, num, body, stream=None):
+        self._offsets[num] = self._pos
+        self._write("%d 0 obj\n%s\n" % (num, body))
+        if stream is not None:
+            self._write("stream\n")
+            self._write(stream)
+            self._write("\nendstream\n")
+        self._write("endobj\n")
+
+    def _reserve(self):
+        num = self._next
+        self._next += 1
+        return num
+
+    def image(self, img):
+        # writes an image XObject and returns its object number; alpha is
+        # flattened onto white paper
+        if img.mode != "RGB":
+            flat = Image.new("RGB", img.size, "white")
+            flat.paste(img, (0, 0), img if img.mode == "RGBA" else None)
+            img = flat
+        data = zlib.compress(img.tobytes(), self.compress_level)
+        num = self._reserve()
+        self._object(num, "<< /Type /XObject /Subtype /Image /Width %d "
+                     "/Height %d /ColorSpace /DeviceRGB /BitsPerComponent 8 "
+                     "/Filter /FlateDecode /Length %d >>" % (
+                         img.size[0], img.size[1], len(data)), data)
+        return num
+
+    def page(self, size, content, images):
+        # size in points; content is the page's drawing operators and images
+        # maps the names it uses (Im3, ...) to image object numbers
+        data = zlib.compress(content, self.compress_level)
+        contents = self._reserve()
+        self._object(contents, "<< /Filter /FlateDecode /Length %d >>" %
+                     len(data), data)
+        num = self._reserve()
+        xobjects = " ".join("/%s %d 0 R" % (name, obj)
+                            for name, obj in sorted(images.items()))
+        self._object(num, "<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %.2f "
+                     "%.2f] /Resources << /XObject << %s >> >> /Contents %d "
+                     "0 R >>" % (size[0], size[1], xobjects, contents))
+        self._pages.append(num)
+
+    def close(self):
+        self._object(1, "<< /Type /Catalog /Pages 2 0 R >>")
+        self._object(2, "<< /Type /Pages /Kids [%s] /Count %d >>" % (
+            " ".join("%d 0 R" % num for num in self._pages), len(self._pages)))
+        xref = self._pos
+        self._write("xref\n0 %d\n0000000000 65535 f \n" % self._next)
+        for num in range(1, self._next):
+            self._write("%010d 00000 n \n" % self._offsets[num])
+        self._write("trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n"
+                    "%%%%EOF\n" % (self._next, xref))
+        self._f.close()
+
+
+def _page_content(plan, page, objects):
+    spec = plan.spec
+    ops = []
+    for name, (x, y, w, h) in page.placements:
+        ops.append("q %.3f 0 0 %.3f %.3f %.3f cm /Im%d Do Q" % (
+            w * POINTS, h * POINTS, x * POINTS, y * POINTS, objects[name]))
+
+    if spec.crop_marks:
+        # short lines in the margin, in line with every cut line
+        xs, ys = spec.cut_lines()
+        left, bottom = spec.origin
+        right, top = left + spec.grid[0], bottom + spec.grid[1]
+        gap, length = spec.mark_offset, spec.mark_length
+        ops.append("0.5 w 0 G")
+        for x in xs:
+            for y1, y2 in ((top + gap, top + gap + length),
+                           (bottom - gap - length, bottom - gap)):
+                ops.append("%.3f %.3f m %.3f %.3f l S" % (
+                    x * POINTS, y1 * POINTS, x * POINTS, y2 * POINTS))
+        for y in ys:
+            for x1, x2 in ((left - gap - length, left - gap),
+                           (right + gap, right + gap + length)):
+                ops.append("%.3f %.3f m %.3f %.3f l S" % (
+                    x1 * POINTS, y * POINTS, x2 * POINTS, y * POINTS))
+    return "\n".join(ops) + "\n"
+
+def write_pdf(plan, path, rendered, compress_level=6):
+    # rendered yields (name, W x H card image) in plan.order(); each card is
+    # cropped to the bleed, written once and reused by every page showing it
+    crop = plan.spec.crop_box()
+    size = (plan.spec.page[0] * POINTS, plan.spec.page[1] * POINTS)
+    pdf = PDFWriter(path, compress_level)
+    objects = {}
+    for page in plan.pages:
+        for name, _ in page.placements:
+            if name not in objects:
+                got, img = next(rendered)
+                assert got == name, (got, name)
+                objects[name] = pdf.image(img.crop(crop))
+        content = _page_content(plan, page, objects)
+        pdf.page(size, content, dict(("Im%d" % objects[name], objects[name])
+                                     for name, _ in page.placements))
+    pdf.close()
@@ -0,0 +1,66 @@
+from PIL import Image, ImageDraw
+from cache import LRUCache
+
+
+class TextStamps(object):
+    # Memoized text sizes and rendered text masks per (font, text). A stamp
+    # is the exact coverage mask ImageDraw.text would fill through, so
+    # pasting the ink through it gives the same pixels as drawing the text.
+    def __init__(self, maxsize=1024):
+        self._sizes = LRUCache(maxsize)
+        self._stamps = LRUCache(maxsize)
+        self._draw = ImageDraw.Draw(Image.new("L", (1, 1)))
+
+    def _key(self, font, text):
+        return (getattr(font, "path", id(font)), getattr(font, "size", None),
+                getattr(font, "index", 0), text)
+
+    def size(self, font, text):
+        return self._sizes.get(self._key(font, text),
+                               lambda: self._draw.textsize(text, font=font))
+
+    def stamp(self, font, text):
+        # (mask, offset from the position passed to ImageDraw.text)
+        def build():
+            core, offset = font.getmask2(text, "L")
+            mask = Image.new("L", core.size)
+            ImageDraw.Draw(mask).text((-offset[0], -offset[1]), text,
+                                      font=font, fill=255)
+            return mask, offset
+        return self._stamps.get(self._key(font, text), build)
+
+STAMPS = TextStamps()
+
+
+class Layout(object):
+    # A card's drawing as a list of placements, worked out before anything
+    # is drawn; render() then just replays them.
+    def __init__(self, stamps=STAMPS):
+        self.stamps = stamps
+        self.ops = []
+
+    def textsize(self, text, font):
+        return self.stamps.size(font, text)
+
+    def text(self, xy, text, font, fill):
+        mask, offset = self.stamps.stamp(font, text)
+        # ImageDraw truncates the final coordinates the same way
+        x, y = int(xy[0] + offset[0]), int(xy[1] + offset[1])
+        self.ops.append(("fill", fill, (x, y, x + mask.size[0], y + mask.size[1]),
+                         mask))
+
+    def image(self, img, xy):
+        # pasted with its own alpha as the mask
+        self.ops.append(("fill", img, xy, img))
+
+    def rectangle(self, box, fill):
+        self.ops.append(("rect", fill, box, None))
+
+    def render(self, img):
+        draw = ImageDraw.Draw(img)
+        for kind, src, box, mask in self.ops:
+            if kind == "rect":
+                draw.rectangle(box, fill=src)
+            else:
+                img.paste(src, box, mask)
+        return img
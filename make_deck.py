@@ -1,197 +1,669 @@
 # -*- coding: utf-8 -*-
 
-import os, sys, math, json
+import os, sys, math, json, time, hashlib, shutil, fnmatch, argparse
 from PIL import Image, ImageDraw, ImageFont
-from helpers import SuitImages, FontImages, GridMaker
-from puzzle_cards import PuzzleText, PuzzleRound
-from card import Card, W, H, SAFE_W, SAFE_H
+from helpers import (SuitImages, FontImages, GridMaker, CornerAtlas,
+                     FONT_PATH, CHINESE_FONT_PATH)
+from assets import ASSETS, SUITS_PATH
+from card import Card, W, H, CUT_W, CUT_H, SAFE_W, SAFE_H, px
+from sheet import SheetWriter
+from output import OutputWriter, FORMATS, encode, write_atomic
+from atlas import AtlasWriter
+from pyramid import pyramid, level_name
+from buffers import POOL
+from deckspec import (CardJob, Variant, load_spec, deck_jobs, suit_names,
+                      special_art, face_art, spec_variants)
+from renderplan import compile_plan, execute
+from pips import pip_layer
+from preload import Preloader, THREADS as PRELOAD_THREADS
+from imposition import PageSpec, ImpositionPlan, write_pdf, PAGE_SIZES
+import tracing
+from tracing import traced
+
+# bump whenever a change to the drawing code alters card pixels, so that
+# incremental builds don't reuse renders from the old code
+RENDER_VERSION = 1
 
 class CardMaker(object):
-    def __init__(self):
-        self.suits = SuitImages()
-        self.gridmaker = GridMaker((int(W), int(H)), margin_w=280, margin_h=280)
-        self.chinese_font = ImageFont.truetype("fonts/NotoSerifCJKsc-Bold.otf", 144,
-                                               encoding="unic")
-        self.font_imgs = FontImages()
-
-    def make_special(self, value, guides=""):
-        card = Card(guides=guides)
-
-        if value is "P":
-            img = Image.open("images/phx.png") # 400x600
-            img = img.resize((540, 810), Image.ANTIALIAS)
-            card.paste(img, int(W/2), int(H/2))
-        elif value is "D":
-            img = Image.open("images/dragon.png") # 480x300
-            img = img.resize((640, 400), Image.ANTIALIAS)
-            card.paste(img, int(W/2), int(H/2))
-        elif value is "O":
-            img = Image.open("images/dog.png") # 480x360
-            img = img.resize((640, 480), Image.ANTIALIAS)
-            card.paste(img, int(W/2), int(H/2))
-        elif value is "M":
-            img = Image.open("images/mahjong.png") # 480x480
-            img = img.resize((640, 640), Image.ANTIALIAS)
-            card.paste(img, int(W/2), int(H/2))
-        else:
-            assert False
+    def __init__(self, assets=ASSETS, composite=False, scale=1.0):
+        # composite collects each card's pastes and blends them in numpy (see
+        # composite.py). The output is the same, but it is 2-3x slower than
+        # pasting, so it is only a cross-check for golden.py and bench.py.
+        # scale renders at another resolution: all the pixel numbers below
+        # are at scale 1 and go through px().
+        self.assets = assets
+        self.composite = composite
+        self.scale = scale
+        self.W, self.H = W * scale, H * scale
+        self.suits = SuitImages(assets)
+        self.gridmaker = GridMaker((int(self.W), int(self.H)),
+                                   margin_w=px(280, scale),
+                                   margin_h=px(280, scale))
+        self.font_imgs = FontImages(cache_dir=assets.cache_dir, assets=assets)
+        self.corners = CornerAtlas(self.font_imgs, assets,
+                                   cache_dir=assets.cache_dir, scale=scale)
+
+    def _card(self, guides):
+        return Card(guides=guides, deferred=self.composite, scale=self.scale)
+
+    def prepare(self, guides="", cut=True):
+        # builds what every card starts from (the blank base and the cut),
+        # which needs no assets, e.g. while a Preloader is busy
+        card = self._card(guides)
+        POOL.release(card.flush(cut=cut))
+
+    # whole cards in one call, outside any render plan (see bench.py); deck
+    # renders go through renderplan.execute, which traces them per layer
 
+    def make_special(self, value, guides="", art=None):
+        # art is (file, size); the deck spec's art for value by default
+        card = self._card(guides)
+        self.draw_art(card, *(art or special_art()[value]))
         self._draw_corners(card, value, None, allfour=True)
         return card
 
-    def make_card(self, num, suit, guides=""):
-        assert 1 <= num <= 10
-        assert 0 <= suit <= 3
-
-        card = Card(guides=guides)
-        suit_img = self.suits._get(suit)
+    def make_card(self, num, suit, guides="", tilt=None):
+        # tilt slopes the pip rows, see GridMaker.tilt
+        card = self._card(guides)
+        self.draw_pips(card, num, suit, tilt)
+        self._draw_corners(card, num, suit, allfour=True)
+        return card
 
-        if num == 1:
-            big_img = suit_img.resize((336, 336), Image.ANTIALIAS)
-            card.paste(big_img, int(W/2), int(H/2))
-        else:
-            small_img = suit_img.resize((144, 144), Image.ANTIALIAS)
-            positions = self.gridmaker.get_positions(num)
-
-            upper, lower = [], []
-            for x, y in positions:
-                if y < H/2 - 0.01 * (x - W/2) + 1:
-                    upper.append((x,y))
-                else:
-                    lower.append((x,y))
-            card.pasten(small_img, upper)
-            card.pasten(small_img.transpose(Image.ROTATE_180), lower)
-
-        self._draw_corners(card, num, suit_img, allfour=True)
+    def make_facecard(self, num, suit, guides="", art=None):
+        # art is (file, size, offset); the deck spec's by default
+        assert 11 <= num <= 13
+        card = self._card(guides)
+        self.draw_frame(card)
+        self.draw_art(card, *(art or face_art()[suit][num - 11]))
+        self._draw_corners(card, num, suit, allfour=True)
         return card
 
+    # the layers cards are made of, also used one by one by renderplan.py
 
-    def make_facecard(self, num, suit, guides=""):
-        card = Card(guides=guides)
+    def draw_pips(self, card, num, suit, tilt=None):
+        assert 1 <= num <= 10
+        assert 0 <= suit <= 3
+        layer = pip_layer(self.gridmaker, (self.W, self.H), suit, num, tilt,
+                          self.scale, self.assets)
+        card.paste_layer(layer.pastes)
 
+    def draw_frame(self, card):
+        # the box around face card art
+        W, H = self.W, self.H
         draw = ImageDraw.Draw(card.img)
-        padw, padh = 210, 200
-        thickness = 4
+        padw, padh = px((210, 200), self.scale)
+        thickness = max(px(4, self.scale), 1)
         draw.rectangle((padw, padh, int(W) - padw, padh + thickness), "black")
         draw.rectangle((padw, int(H) - padh - thickness, int(W) - padw, int(H) - padh), "black")
         draw.rectangle((padw, padh, padw + thickness, int(H) - padh), "black")
         draw.rectangle((int(W) - padw + thickness, padh, int(W) - padw, int(H) - padh), "black")
 
-        FACECARD_DATA = [
-            [
-                ["images/starJ.png", (900, 900), (540, 540), (-28, -28)],
-                ["images/starQ.png", (900, 1260), (525, 735), (0, 0)],
-                ["images/starK.png", (1080, 1380), (540, 690), (36, 25)],
-            ],
-            [
-                ["images/pagodaJ.png", (660, 900), (495, 675), (4, 0)],
-                ["images/pagodaQ.png", (1200, 1200), (600, 600), (0, 0)],
-                ["images/pagodaK.png", (1200, 1320), (600, 660), (0, 30)],
-            ],
-            [
-                ["images/swordJ.png", (600, 900), (400, 600), (0, 0)],
-                ["images/swordQ.png", (997, 1400), (500, 700), (8, -28)],
-                ["images/swordK.png", (1000, 1320), (500, 660), (-28, -28)],
-            ],
-            [
-                ["images/gemJ.png", (480, 960), (330, 660), (0, 0)],
-                ["images/gemQ.png", (720, 1200), (390, 650), (0, 0)],
-                ["images/gemK.png", (960, 1200), (600, 750), (0, 0)],
-            ],
-        ]
-
-        data = FACECARD_DATA[suit]
-        assert 11 <= num <= 13
-        filename, orig_dims, resize_dims, offsets = data[num - 11]
-        img = Image.open(filename)
-        img = img.resize(resize_dims, Image.ANTIALIAS)
-        card.paste(img, int(W/2) + offsets[0], int(H/2) + offsets[1])
-
-        suit_img = self.suits._get(suit)
-        self._draw_corners(card, num, suit_img, allfour=True)
-        return card
+    def draw_art(self, card, filename, dims, offset=(0, 0)):
+        # dims and offset (from the center) in master pixels
+        img = self.assets.get(filename, px(dims, self.scale))
+        offset = px(offset, self.scale)
+        card.paste(img, int(self.W/2) + offset[0], int(self.H/2) + offset[1])
 
-    def _draw_corners(self, card, num, suit_img,
+    @traced("CardMaker._draw_corners",
+            lambda self, card, num, suit, *a, **kw: {"num": num, "suit": suit})
+    def _draw_corners(self, card, num, suit,
                       adjust=(0,0), allfour=False):
-        mw, mh = 130, 300
-        mini = Image.new("RGBA", (mw, mh))
-        draw = ImageDraw.Draw(mini)
-
-        font_img = self.font_imgs.get_img(num)
-        fw, fh = font_img.size
-        mini.paste(font_img, (mw/2 - fw/2, 0))
+        mini, rotated = self.corners.get(num, suit)
+        mw, mh = mini.size
 
-        if suit_img is not None:
-            small = suit_img.resize((120, 120), Image.ANTIALIAS)
-            mini.paste(small, (mw/2 - 60, 132), small)
-
-        ox = int((W - SAFE_W)/2 + mw/2 + adjust[0])
-        oy = int((H - SAFE_H)/2 + mh/2 + adjust[1])
+        W, H = self.W, self.H
+        adjust = px(adjust, self.scale)
+        ox = int((W - SAFE_W * self.scale)/2 + mw/2 + adjust[0])
+        oy = int((H - SAFE_H * self.scale)/2 + mh/2 + adjust[1])
         card.paste(mini, ox, oy)
-        card.paste(mini.transpose(Image.ROTATE_180), int(W) - ox, int(H) - oy)
+        card.paste(rotated, int(W) - ox, int(H) - oy)
         if allfour:
             card.paste(mini, int(W) - ox, oy)
-            card.paste(mini.transpose(Image.ROTATE_180), ox, int(H) - oy)
+            card.paste(rotated, ox, int(H) - oy)
 
 
-def make_deck(guides="C", imgdir=None, spacing=0):
-    if imgdir is not None:
-        if not os.path.exists(imgdir):
-            os.makedirs(imgdir)
-    cm = CardMaker()
-    fulldeck = Image.new("RGBA", (13 * (int(W) + 2 * spacing),
-                                  5 * (int(H) + 2 * spacing)))
-
-    def paste_or_save(card, filename, (c, r)):
-        # TODO: make option
-        img = Image.new("RGBA", card.img.size)
-        img.paste(card.img, (0, 0), card.cut_mask())
-        if imgdir is not None:
-            img.save(os.path.join(imgdir, filename))
-        else:
-            fulldeck.paste(img, (c * (int(W) + 2 * spacing) + spacing,
-                                 r * (int(H) + 2 * spacing) + spacing), img)
-
-    # back
-    back = Card(guides=guides)
-    # ["#2891c4", "#ddcb8d", "#5a8da6", "#ea3944", "#5f5f5f"]
-    # blue, tan, gray-blue, pink, dark gray
-    back.draw_back()
-    paste_or_save(back, "back.png", (0, 0))
-
-    # specials
-    special_names = ["phoenix", "dragon", "dog", "mahjong"]
-    for idx, special in enumerate("PDOM"):
-        card = cm.make_special(special, guides=guides)
-        paste_or_save(card, special_names[idx] + ".png", (idx + 1, 0))
-
-    # teachus
+# alternative spellings of ranks in card names, e.g. "gem Q" for gem12
+RANK_NAMES = {"a": "A", "1": "A", "t": "10", "j": "11", "q": "12", "k": "13"}
+
+def normalize_card_name(name, spec=None):
+    # spec is the loaded deck spec whose suit names are recognized
+    name = name.replace(" ", "").lower()
+    for suit in suit_names(spec):
+        if name.startswith(suit):
+            rank = name[len(suit):]
+            return suit + RANK_NAMES.get(rank, rank.upper())
+    return name
+
+def select_jobs(jobs, patterns, spec=None):
+    # patterns are comma separated card names or globs, e.g. "gem5,star*",
+    # for jobs from the deck spec spec (deck.json by default)
+    selected = set()
+    for pattern in patterns.split(","):
+        pattern = normalize_card_name(pattern, spec)
+        matched = [job.name for job in jobs
+                   if fnmatch.fnmatchcase(job.name, pattern)]
+        if not matched:
+            raise ValueError("no card matches %r" % pattern)
+        selected.update(matched)
+    return [job for job in jobs if job.name in selected]
+
+def repack(jobs, cols=13):
+    # lay a subset of the deck out compactly, keeping deck order
+    cols = min(cols, len(jobs))
+    return [CardJob(job.name, (idx % cols, idx / cols), job.kind, job.args)
+            for idx, job in enumerate(jobs)], cols
+
+def render_job(cm, job, guides="", cut=True):
+    # cut=False keeps the bleed outside the rounded cut line, for printing.
+    # The trace span is execute's, as for every card of a plan.
+    # The image is the card's own canvas, from buffers.POOL; release it when
+    # done.
+    plan = compile_plan([job], [Variant(guides=guides, cut=cut)])
+    for _, _, img in execute(plan, cm):
+        return img
+
+
+def job_sources(job):
+    # files a card is drawn from; corners need both fonts and suits.png
+    corners = [SUITS_PATH, FONT_PATH, CHINESE_FONT_PATH]
+    if job.kind == "back":
+        return [SUITS_PATH]
+    if job.kind == "special":
+        return [(job.args[1:] or special_art()[job.args[0]])[0]] + corners
+    if job.kind == "text":
+        return (sorted(art for art, _ in special_art().values()) +
+                [SUITS_PATH, FONT_PATH])
+    if job.kind == "round":
+        return ["images/hand_up.png", "images/hand_down.png", FONT_PATH]
+    if job.kind == "card":
+        return corners
+    if job.kind == "face":
+        num, suit = job.args[:2]
+        return [(job.args[2:] or face_art()[suit][num - 11])[0]] + corners
+    assert False, job.kind
+
+def asset_manifest(jobs, cm):
+    # the AssetStore keys (see AssetStore.image_key and font) cm will ask
+    # for to draw jobs, in order of first use, for a preload.Preloader
+    assets, scale = cm.assets, cm.scale
+    keys = []
+
+    def image(*args, **kw):
+        keys.append(assets.image_key(*args, **kw))
+
+    def font(path, size, encoding=""):
+        keys.append(("font", path, size, encoding))
+
+    def corners(suit):
+        # rank corners are drawn with the numbers font over a small suit,
+        # the specials' with the CJK font alone
+        if cm.corners.ready():
+            return
+        if suit is not None:
+            image(SUITS_PATH)
+            image(suit, (120, 120))
+        needed = cm.font_imgs.needed_font("numbers" if suit is not None
+                                          else "specials")
+        if needed is not None:
+            font(*needed)
+
+    for job in jobs:
+        if job.kind == "back":
+            image(SUITS_PATH, px((256, 64), scale))
+            image(SUITS_PATH, px((256, 64), scale), 180)
+        elif job.kind == "special":
+            art, dims = (job.args[1:] or special_art()[job.args[0]])[:2]
+            image(art, px(dims, scale))
+            corners(None)
+        elif job.kind == "text":
+            font(FONT_PATH, px(60, scale))
+            image(SUITS_PATH)
+            for art, _ in sorted(special_art().values()):
+                w, h = assets.source_size(art)
+                image(art, px((w / 3, h / 3), scale), resample=None)
+        elif job.kind == "round":
+            font(FONT_PATH, px(40, scale))
+            font(FONT_PATH, px(60, scale))
+            for hand in ("images/hand_up.png", "images/hand_down.png"):
+                image(hand, px((75, 75), scale), resample=None)
+        elif job.kind == "card":
+            num, suit = job.args[:2]
+            image(SUITS_PATH)
+            if num == 1:
+                image(suit, px((336, 336), scale))
+            else:
+                image(suit, px((144, 144), scale))
+                image(suit, px((144, 144), scale), 180)
+            corners(suit)
+        elif job.kind == "face":
+            num, suit = job.args[:2]
+            art, dims = (job.args[2:] or face_art()[suit][num - 11])[:2]
+            image(art, px(dims, scale))
+            corners(suit)
+    manifest = []
+    for key in keys:
+        if key not in manifest:
+            manifest.append(key)
+    return manifest
+
+def job_fingerprint(job, guides="", scale=1.0):
+    # spacing only moves cards around the sheet, so it isn't part of the
+    # per-card fingerprint
+    inputs = [RENDER_VERSION, (W, H, CUT_W, CUT_H, SAFE_W, SAFE_H),
+              job.kind, job.args, guides,
+              [(path, ASSETS.source_digest(path)) for path in job_sources(job)]]
+    if scale != 1:
+        inputs.append(scale)
+    return hashlib.sha1(json.dumps(inputs, sort_keys=True).encode("utf-8")).hexdigest()
+
+class RenderCache(object):
+    # finished, cut cards stored as <fingerprint>.png, at zlib level LEVEL
+    LEVEL = 6
+
+    def __init__(self, path):
+        self.path = path
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+    def filename(self, fingerprint):
+        return os.path.join(self.path, fingerprint + ".png")
+
+    def has(self, fingerprint):
+        return os.path.exists(self.filename(fingerprint))
+
+    def get(self, fingerprint):
+        img = Image.open(self.filename(fingerprint))
+        img.load()
+        return img
+
+    def put(self, fingerprint, img):
+        write_atomic(self.filename(fingerprint),
+                     encode(img, "png", self.LEVEL))
+
+
+# per-process state for pool workers; forked workers inherit the parent's
+# CardMaker, others build their own on startup
+_worker = {}
+
+def _init_worker(guides, trace, composite=False, cut=True, scale=1.0):
+    if "cm" not in _worker:
+        _worker["cm"] = CardMaker(composite=composite, scale=scale)
+    _worker["guides"] = guides
+    _worker["cut"] = cut
+    # spans recorded by the parent before forking belong to the parent
+    tracing.drain()
+    if trace:
+        tracing.enable()
+
+def _render_in_worker(job):
+    img = render_job(_worker["cm"], job, _worker["guides"], _worker["cut"])
+    data = img.tobytes()
+    POOL.release(img)
+    return img.mode, img.size, data, tracing.drain()
+
+def render_jobs(jobs, guides="", workers=1, composite=False, cut=True,
+                scale=1.0, preloader=None):
+    # yields (job, image) in job order, whatever the worker count. The art
+    # and fonts are loaded up front by preloader (a default Preloader if
+    # None), see preload.py.
+    if preloader is None:
+        preloader = Preloader()
+    cm = CardMaker(composite=composite, scale=scale)
+    preloader.start(asset_manifest(jobs, cm))
+    if workers <= 1:
+        # one plan for all of them, so shared layers are drawn once; the
+        # blank base and cut are made while the assets load
+        plan = compile_plan(jobs, [Variant(guides=guides, cut=cut)])
+        cm.prepare(guides, cut)
+        for job, _, img in execute(plan, cm):
+            yield job, img
+        preloader.join()
+        return
+
+    # forked workers get the loaded assets, not the loading threads
+    import multiprocessing
+    preloader.join()
+    _worker["cm"] = cm
+    pool = multiprocessing.Pool(workers, _init_worker,
+                                (guides, tracing.is_enabled(), composite, cut,
+                                 scale))
+    try:
+        results = pool.imap(_render_in_worker, jobs)
+        for job in jobs:
+            mode, size, data, spans = next(results)
+            tracing.add(spans)
+            yield job, Image.frombytes(mode, size, data)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+        _worker.clear()
+
+
+def load_jobs(deck_spec=None):
+    # the cards of the deck spec at path deck_spec (deck.json by default)
     f = open("puzzle_data.json", "r")
     puzzle_data = json.loads(f.read())
     f.close()
+    return deck_jobs(puzzle_data, load_spec(deck_spec))
 
-    ptext = PuzzleText(guides=guides).make_card()
-    paste_or_save(ptext, "teachus.png", (5, 0))
-    for idx, round_data in enumerate(puzzle_data):
-        num = idx + 1
-        codes, tricks, scores = round_data
-        card = PuzzleRound(num, codes, tricks, scores, guides=guides).make_card()
-        paste_or_save(card, "round" + str(num) + ".png", (num + 5, 0))
-
-    # 52 cards
-    for suit in range(4):
-        for num in range(1, 14):
-            if num <= 10:
-                card = cm.make_card(num, suit, guides=guides)
-            else:
-                card = cm.make_facecard(num, suit, guides=guides)
+def make_deck(guides="C", imgdir=None, spacing=0, workers=1, cache_dir=None,
+              incremental=False, trace=None, cards=None, sheet="test.png",
+              composite=False, fmt="png", level=6, encoders=2, timings=False,
+              atlas_dir=None, atlas_size=4096, mip_levels=1, scale=1.0,
+              pyramid_levels=0, deck_spec=None,
+              preload_threads=PRELOAD_THREADS):
+    # imgdir cards are written as fmt (see output.FORMATS) at the given
+    # compression level, and both they and the sheet are encoded on
+    # encoders background threads (0 to encode inline).
+    # atlas_dir packs the cards into texture atlases instead, see atlas.py.
+    # scale renders at another resolution (spacing is in master pixels).
+    # pyramid_levels also writes 1/2, 1/4, ... previews of every imgdir
+    # card into imgdir/1_2, imgdir/1_4 and so on.
+    # incremental builds reuse cards whose inputs haven't changed from
+    # cache_dir/renders; returns the names of the cards actually rendered.
+    # trace names a Chrome trace JSON file to record the build into.
+    # cards selects a subset of the deck by name or glob, see select_jobs.
+    # deck_spec is the path of the deck spec to render, see deckspec.py.
+    # preload_threads load the art and fonts ahead of the cards that need
+    # them (0 to load each on first use), see preload.py.
+    assert cache_dir is not None or not incremental
+    started = time.time()
+    if pyramid_levels and imgdir is None:
+        raise ValueError("pyramid previews need an imgdir")
+    POOL.reset_stats()
+    if trace is not None:
+        tracing.drain()
+        tracing.enable()
+    if imgdir is not None:
+        # lvl, not level: that is the compression level
+        for lvl in range(pyramid_levels + 1):
+            path = os.path.join(imgdir, level_name(lvl)) if lvl else imgdir
+            if not os.path.exists(path):
+                os.makedirs(path)
+    if cache_dir is not None:
+        # keep resized art on disk between builds
+        ASSETS.cache_dir = os.path.join(cache_dir, "assets")
+
+    cw, ch = int(W * scale), int(H * scale)
+    spacing = px(spacing, scale)
+
+    def paste_or_save(img, name, (c, r)):
+        if writer is not None:
+            writer.put(name, img)
+        else:
+            with tracing.span("sheet.paste", card=name):
+                fulldeck.paste(img, (c * (cw + 2 * spacing) + spacing,
+                                     r * (ch + 2 * spacing) + spacing))
+            POOL.release(img)
+
+    jobs = load_jobs(deck_spec)
+    cols = max(job.slot[0] for job in jobs) + 1
+    rows = max(job.slot[1] for job in jobs) + 1
+    if cards is not None:
+        jobs = select_jobs(jobs, cards, load_spec(deck_spec))
+        if imgdir is None and atlas_dir is None:
+            jobs, cols = repack(jobs)
+            rows = (len(jobs) + cols - 1) / cols
+    dirty = jobs
+
+    writer = None
+    if imgdir is not None:
+        writer = OutputWriter(imgdir, fmt, level, encoders, pool=POOL)
+    elif atlas_dir is not None:
+        writer = AtlasWriter(atlas_dir, atlas_size, mip_levels, level=level,
+                             encoders=encoders, pool=POOL)
+    else:
+        # cards are streamed into the sheet in deck order, which is row order
+        fulldeck = SheetWriter(sheet, (cols * (cw + 2 * spacing),
+                                       rows * (ch + 2 * spacing)), ch,
+                               compress_level=level, threaded=encoders > 0)
+
+    if incremental:
+        renders = RenderCache(os.path.join(cache_dir, "renders"))
+        fingerprints = dict((job.name, job_fingerprint(job, guides, scale))
+                            for job in jobs)
+        dirty = [job for job in jobs if not renders.has(fingerprints[job.name])]
+
+    # dirty jobs keep deck order, so they can be merged back in one pass
+    preloader = Preloader(preload_threads)
+    rendered = render_jobs(dirty, guides, workers, composite, scale=scale,
+                           preloader=preloader)
+    dirty_names = set(job.name for job in dirty)
+    render_time = output_time = pyramid_time = 0.0
+    first_card = None
+    for job in jobs:
+        start = time.time()
+        if job.name in dirty_names:
+            _, img = next(rendered)
+            if first_card is None:
+                first_card = time.time() - started
+            if incremental:
+                renders.put(fingerprints[job.name], img)
+        elif (imgdir is not None and fmt == "png" and
+              level == RenderCache.LEVEL and not pyramid_levels):
+            # already encoded as asked, no need to decode it again
+            shutil.copyfile(renders.filename(fingerprints[job.name]),
+                            writer.filename(job.name))
+            continue
+        else:
+            img = renders.get(fingerprints[job.name])
+        mid = time.time()
+        render_time += mid - start
+        if pyramid_levels:
+            # before the master goes to the writer, which releases it
+            with tracing.span("pyramid", card=job.name):
+                previews = pyramid(img, pyramid_levels)
+            pyramid_time += time.time() - mid
+            mid = time.time()
+            for lvl, preview in enumerate(previews, 1):
+                writer.put(os.path.join(level_name(lvl), job.name), preview)
+        paste_or_save(img, job.name, job.slot)
+        output_time += time.time() - mid
+
+    start = time.time()
+    if writer is None:
+        with tracing.span("sheet.close"):
+            fulldeck.close()
+    else:
+        writer.close()
+    output_time += time.time() - start
+
+    if timings:
+        if writer is not None:
+            print(writer.format_stats(render_time))
+            if pyramid_levels:
+                print("%d preview levels in %.2fs (%.0f%% of render)" % (
+                    pyramid_levels, pyramid_time,
+                    100 * pyramid_time / max(render_time, 1e-9)))
+        else:
+            print("render %.2fs, sheet %.2fs (paste, filter and waiting on "
+                  "zlib)" % (render_time, output_time))
+        print(POOL.format_stats())
+        if first_card is not None:
+            print("first card %.2fs after start" % first_card)
+        print(preloader.format_stats())
+    if incremental:
+        print("rebuilt %d of %d cards%s" % (
+            len(dirty), len(jobs),
+            (": " + ", ".join(job.name for job in dirty)) if dirty else ""))
+    if trace is not None:
+        tracing.write_chrome_trace(trace)
+        print(tracing.format_summary())
+        tracing.disable()
+    return [job.name for job in dirty]
+
+def make_pdf(path, spec=None, guides="", decks=1, workers=1, cards=None,
+             composite=False, level=6, deck_spec=None):
+    # print-ready PDF of the deck fronts (and backs, if spec.duplex), laid
+    # out by an ImpositionPlan; returns the plan
+    if spec is None:
+        spec = PageSpec()
+    jobs = load_jobs(deck_spec)
+    by_name = dict((job.name, job) for job in jobs)
+    if spec.duplex and spec.back not in by_name:
+        raise ValueError("duplex needs a %r card for the backs, and the deck "
+                         "spec has none" % spec.back)
+    fronts = (select_jobs(jobs, cards, load_spec(deck_spec))
+              if cards is not None else jobs)
+    plan = ImpositionPlan([job.name for job in fronts
+                           if job.name != spec.back], spec, decks)
+
+    # cards are rendered once each, in the order the PDF needs them
+    rendered = render_jobs([by_name[name] for name in plan.order()], guides,
+                           workers, composite, cut=False)
+    with tracing.span("write_pdf"):
+        write_pdf(plan, path, _recycled(rendered), level)
+    return plan
+
+def make_variants(outdir, variants=None, deck_spec=None, cards=None,
+                  composite=False, fmt="png", level=6, encoders=2, scale=1.0,
+                  timings=False, preload_threads=PRELOAD_THREADS):
+    # renders the deck once per variant (deckspec.Variant; the spec's own
+    # "variants" by default) into outdir/<variant name>. It is all one
+    # render plan, so layers the variants have in common are drawn once.
+    variants = variants or spec_variants(load_spec(deck_spec))
+    jobs = load_jobs(deck_spec)
+    if cards is not None:
+        jobs = select_jobs(jobs, cards, load_spec(deck_spec))
+    POOL.reset_stats()
+    writers = {}
+    for variant in variants:
+        path = os.path.join(outdir, variant.name)
+        if not os.path.exists(path):
+            os.makedirs(path)
+        writers[variant.name] = OutputWriter(path, fmt, level, encoders,
+                                             pool=POOL)
+
+    start = time.time()
+    cm = CardMaker(composite=composite, scale=scale)
+    preloader = Preloader(preload_threads)
+    preloader.start(asset_manifest(jobs, cm))
+    plan = compile_plan(jobs, variants)
+    for variant in variants:
+        cm.prepare(variant.guides, variant.cut)
+    for job, variant, img in execute(plan, cm):
+        writers[variant.name].put(job.name, img)
+    render_time = time.time() - start
+    preloader.join()
+    for writer in writers.values():
+        writer.close()
+    if timings:
+        print(plan.describe())
+        print("%d cards in %d variants rendered in %.2fs, written in %.2fs" % (
+            len(jobs), len(variants), render_time,
+            time.time() - start - render_time))
+        print(POOL.format_stats())
+        print(preloader.format_stats())
+    return plan
 
-            suit_name = ["star", "pagoda", "sword", "gem"]
-            num_name = "A" if num == 1 else str(num)
-            paste_or_save(card, suit_name[suit] + num_name + ".png",
-                          (num - 1, suit + 1))
+def _recycled(rendered):
+    # write_pdf is done with a card once it asks for the next one
+    for job, img in rendered:
+        yield job.name, img
+        POOL.release(img)
 
-    fulldeck.save("test.png")
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Render the tichu deck.")
+    parser.add_argument("--cards", default=None,
+                        help="comma separated card names or globs, e.g. "
+                        "'gem5,star*,dragon' (default: whole deck)")
+    parser.add_argument("--imgdir", default=None,
+                        help="write one PNG per card here instead of a sheet")
+    parser.add_argument("--sheet", default="test.png")
+    parser.add_argument("--guides", default="",
+                        help="C for cut lines, S for safe area")
+    parser.add_argument("--spacing", type=int, default=-36)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--cache-dir", default=None)
+    parser.add_argument("--incremental", action="store_true")
+    parser.add_argument("--trace", default=None,
+                        help="write a Chrome trace of the build here")
+    parser.add_argument("--format", default="png", choices=sorted(FORMATS),
+                        help="file format for --imgdir cards")
+    parser.add_argument("--level", type=int, default=6,
+                        help="zlib level for png, effort (0-6) for webp")
+    parser.add_argument("--encoders", type=int, default=2,
+                        help="background encoding threads, 0 for none")
+    parser.add_argument("--preload-threads", type=int,
+                        default=PRELOAD_THREADS,
+                        help="threads loading art and fonts ahead of the "
+                        "cards, 0 to load on first use")
+    parser.add_argument("--timings", action="store_true",
+                        help="report render time against encode/write time")
+    parser.add_argument("--scale", type=float, default=1.0,
+                        help="render at this fraction of full resolution")
+    parser.add_argument("--pyramid", type=int, default=0,
+                        help="also write this many halved previews per card")
+    parser.add_argument("--atlas-dir", default=None,
+                        help="pack the cards into texture atlases here")
+    parser.add_argument("--atlas-size", type=int, default=4096,
+                        help="largest atlas side, a power of two")
+    parser.add_argument("--mip-levels", type=int, default=1)
+    parser.add_argument("--deck-spec", default=None,
+                        help="JSON deck spec to render (default: deck.json)")
+    parser.add_argument("--variants", default=None,
+                        help="render every variant in the deck spec into "
+                        "this directory instead")
+    parser.add_argument("--pdf", default=None,
+                        help="write a print-ready PDF here instead")
+    parser.add_argument("--page", default="letter", choices=sorted(PAGE_SIZES))
+    parser.add_argument("--grid", default=None,
+                        help="cards per page, CxR (default: 3x3, 1x1 for "
+                        "poker)")
+    parser.add_argument("--bleed", type=float, default=None,
+                        help="inches of art kept beyond the cut line "
+                        "(default: none, all of it for poker)")
+    parser.add_argument("--gutter", type=float, default=0.0,
+                        help="inches between neighbouring bleeds")
+    parser.add_argument("--no-crop-marks", action="store_true",
+                        help="(poker pages never have them)")
+    parser.add_argument("--duplex", choices=["long", "short"], default=None,
+                        help="add a page of backs behind every page of fronts")
+    parser.add_argument("--decks", type=int, default=1)
+    args = parser.parse_args(argv)
+    if args.incremental and args.cache_dir is None:
+        parser.error("--incremental needs --cache-dir")
+    if args.pdf is not None:
+        try:
+            cols = rows = None
+            if args.grid is not None:
+                cols, rows = (int(n) for n in args.grid.lower().split("x"))
+            spec = PageSpec(args.page, cols, rows, bleed=args.bleed,
+                            gutter=args.gutter,
+                            crop_marks=False if args.no_crop_marks else None,
+                            duplex=args.duplex)
+            plan = make_pdf(args.pdf, spec, guides=args.guides,
+                            decks=args.decks, workers=args.workers,
+                            cards=args.cards, level=args.level,
+                            deck_spec=args.deck_spec)
+        except ValueError as e:
+            parser.error(str(e))
+        print(plan.describe().split("\n")[0])
+        return
+    if args.variants is not None:
+        try:
+            make_variants(args.variants, deck_spec=args.deck_spec,
+                          cards=args.cards, fmt=args.format, level=args.level,
+                          encoders=args.encoders, scale=args.scale,
+                          timings=args.timings,
+                          preload_threads=args.preload_threads)
+        except ValueError as e:
+            parser.error(str(e))
+        return
+    try:
+        make_deck(guides=args.guides, imgdir=args.imgdir, spacing=args.spacing,
+                  workers=args.workers, cache_dir=args.cache_dir,
+                  incremental=args.incremental, trace=args.trace,
+                  cards=args.cards, sheet=args.sheet, fmt=args.format,
+                  level=args.level, encoders=args.encoders,
+                  timings=args.timings, atlas_dir=args.atlas_dir,
+                  atlas_size=args.atlas_size, mip_levels=args.mip_levels,
+                  scale=args.scale, pyramid_levels=args.pyramid,
+                  deck_spec=args.deck_spec,
+                  preload_threads=args.preload_threads)
+    except ValueError as e:
+        parser.error(str(e))
 
-make_deck(guides="", spacing=-36)
-#make_deck(guides="", imgdir="cards")
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+import os, io, sys, time, tempfile, threading
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import tracing
+
+# Encodes and writes finished cards on background threads, so rendering the
+# next card doesn't wait for zlib. PIL's encoders and file writes release
+# the GIL, so threads are enough here.
+#
+#   out = OutputWriter("cards", fmt="webp")
+#   for name, img in ...:
+#       out.put(name, img) # blocks only while the queue is full
+#   out.close()
+#   print(out.format_stats(render_time))
+
+# format -> file extension. raw is the bare RGBA bytes, row by row, with
+# the image size left to the reader (cards are all W x H).
+FORMATS = {"png": ".png", "webp": ".webp", "raw": ".rgba"}
+
+def encode(img, fmt="png", level=6):
+    # level is the zlib level (0-9) for png and the effort (0-6) for the
+    # lossless webp encoder
+    if fmt == "raw":
+        return img.tobytes()
+    data = io.BytesIO()
+    if fmt == "png":
+        img.save(data, "PNG", compress_level=level)
+    elif fmt == "webp":
+        img.save(data, "WEBP", lossless=True, quality=100,
+                 method=min(level, 6))
+    else:
+        raise ValueError("unknown output format %r" % fmt)
+    return data.getvalue()
+
+# mkstemp makes files only their owner can read; the files it renames into
+# place get the mode open() would have given them instead
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+def temp_file(path):
+    # (open file, its name) to write path's contents to before renaming it
+    # into place. The name is unique, so processes and threads writing the
+    # same path don't share a temporary, and it sits next to path, so the
+    # rename stays on one filesystem.
+    fd, tmp = tempfile.mkstemp(prefix=os.path.basename(path) + ".",
+                               suffix=".tmp",
+                               dir=os.path.dirname(path) or ".")
+    os.chmod(tmp, 0o666 & ~UMASK)
+    return os.fdopen(fd, "wb"), tmp
+
+def write_atomic(path, data):
+    # readers never see a half-written file
+    f, tmp = temp_file(path)
+    try:
+        try:
+            f.write(data)
+        finally:
+            f.close()
+        os.rename(tmp, path)
+    except Exception:
+        os.remove(tmp)
+        raise
+
+
+class OutputWriter(object):
+    def __init__(self, imgdir, fmt="png", level=6, threads=2, queue_size=8,
+                 pool=None):
+        # threads=0 encodes and writes inline in put(). Images are handed
+        # back to pool (see buffers.py) once encoded.
+        if fmt not in FORMATS:
+            raise ValueError("unknown output format %r" % fmt)
+        self.imgdir = imgdir
+        self.fmt = fmt
+        self.level = level
+        self.threads = threads
+        self.pool = pool
+        self.times = {"encode": 0.0, "write": 0.0, "wait": 0.0}
+        self.files = self.bytes = 0
+        self._error = None
+        self._lock = threading.Lock()
+
+        self._queue = queue.Queue(queue_size)
+        self._threads = []
+        for _ in range(threads):
+            t = threading.Thread(target=self._work)
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def filename(self, name):
+        return os.path.join(self.imgdir, name + FORMATS[self.fmt])
+
+    def put(self, name, img):
+        if self._error is not None:
+            self._raise()
+        if not self._threads:
+            self._save(name, img)
+            return
+        start = time.time()
+        with tracing.span("output.wait", card=name):
+            self._queue.put((name, img))
+        self.times["wait"] += time.time() - start
+
+    def close(self):
+        for _ in self._threads:
+            self._queue.put(None)
+        for t in self._threads:
+            t.join()
+        self._threads = []
+        if self._error is not None:
+            self._raise()
+
+    def _raise(self):
+        exc_info, self._error = self._error, None
+        raise exc_info[0], exc_info[1], exc_info[2]
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            if self._error is not None:
+                continue # keep draining so put() never blocks forever
+            try:
+                self._save(*item)
+            except Exception:
+                self._error = sys.exc_info()
+
+    def _save(self, name, img):
+        start = time.time()
+        with tracing.span("encode", card=name):
+            data = encode(img, self.fmt, self.level)
+        if self.pool is not None:
+            self.pool.release(img)
+        mid = time.time()
+        with tracing.span("write", card=name):
+            write_atomic(self.filename(name), data)
+        end = time.time()
+        with self._lock:
+            self.times["encode"] += mid - start
+            self.times["write"] += end - mid
+            self.files += 1
+            self.bytes += len(data)
+
+    def stats(self):
+        with self._lock:
+            ret = dict(self.times)
+            ret.update(files=self.files, bytes=self.bytes,
+                       threads=self.threads)
+        return ret
+
+    def format_stats(self, render_time):
+        # encode and write are summed over threads, so with threads they
+        # can add up to more than the wall time
+        return ("render %.2fs, encode %.2fs, write %.2fs, waited %.2fs on "
+                "the output queue; %d %s files at level %d, %.1f MB" % (
+                    render_time, self.times["encode"], self.times["write"],
+                    self.times["wait"], self.files, self.fmt, self.level,
+                    self.bytes / 1e6))
@@ -0,0 +1,44 @@
+from cache import LRUCache
+from assets import ASSETS
+from card import px
+
+# The pips of a number card, laid out once per (suit, count, tilt, margin,
+# size) and kept in a bounded cache: which sprite goes where, upright above
+# the card's (slightly sloped) midline and upside down below it. Drawing
+# them is one Card.paste_layer call with no layout work per card.
+#
+# The pastes are kept as separate pips rather than merged into one sprite:
+# pasting costs per pixel covered, and the merged bounding box is mostly
+# transparent, so one big paste measured slower than the pips one by one.
+
+LAYERS = LRUCache(maxsize=64)
+
+class PipLayer(object):
+    def __init__(self, gridmaker, dims, suit, num, tilt=None, scale=1.0,
+                 assets=ASSETS):
+        # dims is the card size at scale, as floats
+        W, H = dims
+        if num == 1:
+            big = assets.get(suit, px((336, 336), scale))
+            placed = [(big, int(W/2), int(H/2))]
+        else:
+            small = assets.get(suit, px((144, 144), scale))
+            rotated = assets.get(suit, px((144, 144), scale), 180)
+            upper, lower = [], []
+            for x, y in gridmaker.get_positions(num, tilt):
+                if y < H/2 - 0.01 * (x - W/2) + 1:
+                    upper.append((small, x, y))
+                else:
+                    lower.append((rotated, x, y))
+            placed = upper + lower
+
+        # (sprite, left, top), in paste order
+        self.pastes = []
+        for sprite, x, y in placed:
+            w, h = sprite.size
+            self.pastes.append((sprite, x - w/2, y - h/2))
+
+def pip_layer(gridmaker, dims, suit, num, tilt=None, scale=1.0, assets=ASSETS):
+    key = (suit, num, tilt, gridmaker.margin, tuple(dims), scale, id(assets))
+    return LAYERS.get(key, lambda: PipLayer(gridmaker, dims, suit, num, tilt,
+                                            scale, assets))
@@ -0,0 +1,117 @@
+import time, threading
+from multiprocessing.pool import ThreadPool
+from assets import ASSETS
+
+# Opening the art and fonts one at a time, on first use, puts all of it in
+# front of the first card. A Preloader loads a manifest of AssetStore keys
+# (see make_deck.asset_manifest) on a few threads instead, PIL's decoders
+# and resizes releasing the GIL, while the caller goes on with the parts of
+# rendering that need no assets. AssetStore.get and font wait for a key
+# that is still loading rather than loading it again.
+#
+#   preloader = Preloader()
+#   preloader.start(asset_manifest(jobs, cm))
+#   ... # render as usual
+#   preloader.join()
+#   print(preloader.format_stats())
+
+THREADS = 4
+
+
+def key_name(key):
+    # e.g. "images/dog.png 640x480", "suit 2 144x144 rot180",
+    # "fonts/Acme-Regular.ttf @60"
+    if key[0] == "font":
+        _, path, size, encoding = key
+        return "%s @%d%s" % (path, size, " " + encoding if encoding else "")
+    source, size, rotation, _ = key
+    name = source if not isinstance(source, int) else "suit %d" % source
+    if size is not None:
+        name += " %dx%d" % size
+    if rotation:
+        name += " rot%d" % rotation
+    return name
+
+
+class _Pending(object):
+    # what AssetStore waits on for one key, timing how long it waited. An
+    # Event rather than the pool's AsyncResult, whose wait wakes only one
+    # of several waiting threads on Python 2.
+    def __init__(self):
+        self.done = threading.Event()
+        self.waited = 0.0
+
+    def wait(self):
+        start = time.time()
+        self.done.wait()
+        self.waited += time.time() - start
+
+
+class Preloader(object):
+    def __init__(self, threads=THREADS, assets=ASSETS):
+        self.threads = threads
+        self.assets = assets
+        # per key, in manifest order: [key, started (s after start), load
+        # time, _Pending]; the times are None until the key is loaded
+        self.loads = []
+        self._pool = None
+        self._start = self._end = None
+        self._lock = threading.Lock()
+
+    def start(self, manifest):
+        # manifest is a list of AssetStore keys, most urgent first
+        self._start = time.time()
+        manifest = [key for key in manifest if not self.assets.loaded(key)]
+        if not manifest or self.threads <= 0:
+            self._end = self._start
+            return
+        self._pool = ThreadPool(min(self.threads, len(manifest)))
+        for key in manifest:
+            entry = [key, None, None, _Pending()]
+            self.loads.append(entry)
+            self.assets.expect(key, entry[3])
+            self._pool.apply_async(self._load, (entry,))
+        self._pool.close()
+
+    def join(self):
+        # needed before forking: the loading threads don't carry over
+        if self._pool is not None:
+            self._pool.join()
+            self._pool = None
+        if self._end is None:
+            self._end = time.time()
+
+    def _load(self, entry):
+        start = time.time()
+        try:
+            self.assets.fill(entry[0])
+        finally:
+            end = time.time()
+            with self._lock:
+                entry[1], entry[2] = start - self._start, end - start
+                self._end = max(self._end or end, end)
+            entry[3].done.set()
+
+    def format_stats(self):
+        if not self.loads:
+            return "preload: nothing to load"
+        waited = sum(entry[3].waited for entry in self.loads)
+        lines = ["preload: %d assets on %d threads in %.2fs, %.2fs of it "
+                 "waited for" % (len(self.loads), self._pool_size(),
+                                 (self._end or time.time()) - self._start,
+                                 waited)]
+        # slowest first
+        for key, started, took, pending in sorted(
+                self.loads, key=lambda entry: -(entry[2] or 0)):
+            if took is None:
+                lines.append("  %-40s not loaded" % key_name(key))
+                continue
+            line = "  %-40s %6.1fms at +%.0fms" % (key_name(key), took * 1e3,
+                                                    started * 1e3)
+            if pending.waited:
+                line += ", waited for %.1fms" % (pending.waited * 1e3)
+            lines.append(line)
+        return "\n".join(lines)
+
+    def _pool_size(self):
+        return min(self.threads, len(self.loads))
@@ -1,36 +1,43 @@
 # -*- coding: utf-8 -*-
 
-import os, sys, math, json
+import os, sys, math, json, itertools
 from PIL import Image, ImageDraw, ImageFont
-from card import Card
+from card import Card, px
+from assets import ASSETS
+from helpers import FONT_PATH
+from tracing import traced
+from layout import Layout
 
 
 class PuzzleText(object):
-    def __init__(self, guides="CS"):
-        self.acme = ImageFont.truetype("fonts/Acme-Regular.ttf", 60)
+    def __init__(self, guides="CS", assets=ASSETS, scale=1.0):
+        # pixel numbers are at scale 1 and go through self.px
+        self.scale = scale
+        self.acme = assets.font(FONT_PATH, self.px(60))
+        self.assets = assets
 
         self.images = images = {}
-        images["P"] = Image.open("images/phx.png") # 400x600
-        images["D"] = Image.open("images/dragon.png") # 480x300
-        images["O"] = Image.open("images/dog.png") # 480x360
-        images["M"] = Image.open("images/mahjong.png") # 480x480
+        images["P"] = "images/phx.png" # 400x600
+        images["D"] = "images/dragon.png" # 480x300
+        images["O"] = "images/dog.png" # 480x360
+        images["M"] = "images/mahjong.png" # 480x480
 
-        self.suits = {}
-        suits_img = Image.open("images/suits.png") # each 192x192
+        self.suits = {} # indices into suits.png, each 192x192
         for idx, suit in enumerate(["star", "pagoda", "sword", "gem"]):
-            self.suits[suit] = suits_img.crop((idx * 192, 0, (idx+1) * 192, 192))
+            self.suits[suit] = idx
 
-        self.card = Card(guides=guides)
+        self.card = Card(guides=guides, scale=scale)
 
-    def _draw_line(self, line, y):
-        draw = ImageDraw.Draw(self.card.img)
+    def px(self, value):
+        return px(value, self.scale)
 
+    def _draw_line(self, layout, line, y):
         cur_x = 0
         pos_x = []
         for item in line:
             pos_x.append(cur_x)
             if isinstance(item, str):
-                tw, _ = draw.textsize(item, font=self.acme)
+                tw, _ = layout.textsize(item, font=self.acme)
                 cur_x += tw
             else:
                 cur_x += item.size[0]
@@ -40,48 +47,82 @@ class PuzzleText(object):
         start_x = W/2 - total_width/2
         for item, x in zip(line, pos_x):
             if isinstance(item, str):
-                draw.text((start_x + x, y), item, font=self.acme, fill="black")
+                layout.text((start_x + x, y), item, font=self.acme, fill="black")
             else:
-                pos = (start_x + x, y + 50 - item.size[1]/2)
-                self.card.img.paste(item, pos, item)
+                pos = (start_x + x, y + self.px(50) - item.size[1]/2)
+                layout.image(item, pos)
 
+    @traced("PuzzleText.make_card")
     def make_card(self):
-        def rescale(img):
+        def rescale(filename):
             a, b = 1, 3
-            w, h = img.size
-            return img.resize((w * a / b, h * a / b))
+            w, h = self.assets.source_size(filename)
+            return self.assets.get(filename, self.px((w * a / b, h * a / b)),
+                                   resample=None)
+        def suit(name, dims):
+            return self.assets.get(self.suits[name], self.px(dims),
+                                   resample=None)
         def adjust(img, pad=0, yshift=0):
             w, h = img.size
+            pad, yshift = self.px((pad, yshift))
             return img.crop((-pad, min(-yshift, 0), w + pad, max(h, h - yshift)))
 
         mahjong = adjust(rescale(self.images["M"]), pad=18)
-        sword = adjust(self.suits["sword"].resize((96, 96)), pad=24, yshift=-16)
+        sword = adjust(suit("sword", (96, 96)), pad=24, yshift=-16)
 
-        star = adjust(self.suits["star"].resize((96, 96)), pad=20, yshift=-16)
+        star = adjust(suit("star", (96, 96)), pad=20, yshift=-16)
         dog = adjust(rescale(self.images["O"]), pad=22, yshift=-30)
 
         dragon = adjust(rescale(self.images["D"]), pad=18, yshift=-16)
         phoenix = adjust(rescale(self.images["P"]), pad=16, yshift=8)
 
-        gem = adjust(self.suits["gem"].resize((90, 90)), pad=0)
-        pagoda = adjust(self.suits["pagoda"].resize((96, 96)), pad=10)
+        gem = adjust(suit("gem", (90, 90)), pad=0)
+        pagoda = adjust(suit("pagoda", (96, 96)), pad=10)
 
         lines = [["Teach us, in life,"],
                  ["  to be", mahjong, "and", sword, ","],
                  ["  to be", star, "and", dog, ","],
                  [" and as", dragon, "and", phoenix, ","],
                  ["to have   ", gem, pagoda, "."]]
+        layout = Layout()
         for idx, line in enumerate(lines):
-            self._draw_line(line, 180 + idx * 160)
+            self._draw_line(layout, line, self.px(180 + idx * 160))
+        layout.render(self.card.img)
         return self.card
 
 
+class PuzzleResources(object):
+    # fonts and hand images used by every round card; build one and share it
+    def __init__(self, assets=ASSETS, scale=1.0):
+        self.scale = scale
+        self.acme_small = assets.font(FONT_PATH, px(40, scale))
+        self.acme_large = assets.font(FONT_PATH, px(60, scale))
+        self.assets = assets
+        self.uphand = "images/hand_up.png"
+        self.downhand = "images/hand_down.png"
+        # decode and resize both hands up front
+        for hand in (self.uphand, self.downhand):
+            assets.get(hand, px((75, 75), scale), resample=None)
+
+_resources = {}
+
+def default_resources(scale=1.0):
+    if scale not in _resources:
+        _resources[scale] = PuzzleResources(scale=scale)
+    return _resources[scale]
+
+
 class PuzzleRound(object):
-    def __init__(self, round_num, codes, tricks, scores, guides="CS"):
-        self.acme_small = ImageFont.truetype("fonts/Acme-Regular.ttf", 40)
-        self.acme_large = ImageFont.truetype("fonts/Acme-Regular.ttf", 60)
-        self.uphand = Image.open("images/hand_up.png")
-        self.downhand = Image.open("images/hand_down.png")
+    def __init__(self, round_num, codes, tricks, scores, guides="CS",
+                 resources=None):
+        if resources is None:
+            resources = default_resources()
+        self.scale = resources.scale
+        self.acme_small = resources.acme_small
+        self.acme_large = resources.acme_large
+        self.assets = resources.assets
+        self.uphand = resources.uphand
+        self.downhand = resources.downhand
 
         self.round_num = round_num
         self.codes = codes
@@ -89,88 +130,165 @@ class PuzzleRound(object):
         self.tricks = tricks
         self.scores = (x if isinstance(x, str) else str(x) for x in scores)
 
-        self.card = Card(guides=guides)
+        self.card = Card(guides=guides, scale=self.scale)
         self.W, self.H = self.card.size()
-        self.hand_spacing = 60
+        self.hand_spacing = self.px(60)
 
-    def _draw_numbered_hand(self, x, y, num, orientation):
+    def px(self, value):
+        # pixel numbers below are at scale 1
+        return px(value, self.scale)
+
+    def _draw_numbered_hand(self, layout, x, y, num, orientation):
         hand_img = (self.uphand if orientation == "u" else self.downhand)
-        hand_img = hand_img.resize((75, 75))
-        self.card.img.paste(hand_img, (x + self.hand_spacing/2 - 75/2, y), hand_img)
+        hand_img = self.assets.get(hand_img, self.px((75, 75)), resample=None)
         w, h = hand_img.size
+        layout.image(hand_img, (x + self.hand_spacing/2 - w/2, y))
 
-        draw = ImageDraw.Draw(self.card.img)
-        tw, th = draw.textsize(str(num), font=self.acme_small)
-        draw.text((x + self.hand_spacing/2 - tw/2, y + h/2 - th/2 - 6),
-                  str(num), font=self.acme_small, fill="black")
+        tw, th = layout.textsize(str(num), font=self.acme_small)
+        layout.text((x + self.hand_spacing/2 - tw/2,
+                     y + h/2 - th/2 - self.px(6)),
+                    str(num), font=self.acme_small, fill="black")
 
-    def _draw_code(self, code, y):
-        cur_x = self.W/2 - sum(30 if x in (None, "-") else self.hand_spacing for x in code) / 2
+    def _draw_code(self, layout, code, y):
+        gap = self.px(30)
+        cur_x = self.W/2 - sum(gap if x in (None, "-") else self.hand_spacing for x in code) / 2
         for idx, token in enumerate(code):
             if token in (None, "-"):
                 if token == "-":
-                    draw = ImageDraw.Draw(self.card.img)
-                    draw.rectangle((cur_x + 8, y + 35, cur_x + 22, y + 39), fill="black")
-                cur_x += 30
+                    x1, y1, x2, y2 = self.px((8, 35, 22, 39))
+                    layout.rectangle((cur_x + x1, y + y1, cur_x + x2, y + y2),
+                                     fill="black")
+                cur_x += gap
                 continue
 
             orientation = token[-1]
             num = int(token[:-1])
-            self._draw_numbered_hand(cur_x, y, num, orientation)
+            self._draw_numbered_hand(layout, cur_x, y, num, orientation)
             cur_x += self.hand_spacing
 
-    def _draw_scores(self):
-        draw = ImageDraw.Draw(self.card.img)
-        x0, y0 = self.W - 280, self.H - 200
-        x1, y1 = x0 + 90, y0 + 50
-        x2, y2 = x0 + 180, y0 + 100
+    def _draw_scores(self, layout):
+        px = self.px
+        x0, y0 = self.W - px(280), self.H - px(200)
+        x1, y1 = x0 + px(90), y0 + px(50)
+        x2, y2 = x0 + px(180), y0 + px(100)
+        half, pad = max(px(2), 1), px(10)
 
         # draw cross
-        draw.rectangle((x0, y1 - 2, x2, y1 + 2), fill="black")
-        draw.rectangle((x1 - 2, y0, x1 + 2, y2), fill="black")
+        layout.rectangle((x0, y1 - half, x2, y1 + half), fill="black")
+        layout.rectangle((x1 - half, y0, x1 + half, y2), fill="black")
 
         s1, tot1, s2, tot2 = self.scores
-        tw, th = draw.textsize(s1, font=self.acme_small)
-        draw.text((x1 - tw - 10, y1 - th - 10), s1, font=self.acme_small, fill="black")
-        tw, th = draw.textsize(s2, font=self.acme_small)
-        draw.text((x2 - tw - 10, y1 - th - 10), s2, font=self.acme_small, fill="black")
-
-        tw, th = draw.textsize(tot1, font=self.acme_small)
-        draw.text((x1 - tw - 10, y2 - th - 10), tot1, font=self.acme_small, fill="blue")
-        tw, th = draw.textsize(tot2, font=self.acme_small)
-        draw.text((x2 - tw - 10, y2 - th - 10), tot2, font=self.acme_small, fill="blue")
-
+        tw, th = layout.textsize(s1, font=self.acme_small)
+        layout.text((x1 - tw - pad, y1 - th - pad), s1, font=self.acme_small, fill="black")
+        tw, th = layout.textsize(s2, font=self.acme_small)
+        layout.text((x2 - tw - pad, y1 - th - pad), s2, font=self.acme_small, fill="black")
+
+        tw, th = layout.textsize(tot1, font=self.acme_small)
+        layout.text((x1 - tw - pad, y2 - th - pad), tot1, font=self.acme_small, fill="blue")
+        tw, th = layout.textsize(tot2, font=self.acme_small)
+        layout.text((x2 - tw - pad, y2 - th - pad), tot2, font=self.acme_small, fill="blue")
+
+    @traced("PuzzleRound.make_card",
+            lambda self, *a, **kw: {"round": self.round_num})
     def make_card(self, guides=""):
         W, H = self.W, self.H
+        px = self.px
 
-        cur_y = 100
-        draw = ImageDraw.Draw(self.card.img)
+        cur_y = px(100)
+        layout = Layout()
 
         t = "Round " + str(self.round_num)
-        tw, th = draw.textsize(t, font=self.acme_large)
-        draw.text((W/2 - tw/2, cur_y), t, font=self.acme_large, fill="black")
+        tw, th = layout.textsize(t, font=self.acme_large)
+        layout.text((W/2 - tw/2, cur_y), t, font=self.acme_large, fill="black")
 
-        cur_y += 120
-        self._draw_code(self.codes[0], cur_y)
-        cur_y += 85
-        self._draw_code(self.codes[1], cur_y)
+        cur_y += px(120)
+        self._draw_code(layout, self.codes[0], cur_y)
+        cur_y += px(85)
+        self._draw_code(layout, self.codes[1], cur_y)
 
-        row_spacing = 45
-        inner_w = 540
-        cur_y += 110
+        row_spacing = px(45)
+        inner_w = px(540)
+        cur_y += px(110)
         for idx, r in enumerate(self.tricks):
             r = r.replace("-", u"—")
             tokens = r.split(" ")
             r = "   ".join(tokens)
             r = r.replace(".", " . ")
 
-            draw.text((W/2 - inner_w/2, cur_y + row_spacing * idx),
-                      r, font=self.acme_small, fill="black")
+            layout.text((W/2 - inner_w/2, cur_y + row_spacing * idx),
+                        r, font=self.acme_small, fill="black")
 
-        self._draw_scores()
+        self._draw_scores(layout)
+        layout.render(self.card.img)
         return self.card
 
 
+def read_rounds(path):
+    # a .jsonl file is streamed one record per line; anything else is read
+    # as a single JSON list like puzzle_data.json
+    f = open(path, "r")
+    try:
+        if path.endswith(".jsonl"):
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            for record in json.loads(f.read()):
+                yield record
+    finally:
+        f.close()
+
+def _unpack(record):
+    if isinstance(record, dict):
+        return record["codes"], record["tricks"], record["scores"]
+    codes, tricks, scores = record
+    return codes, tricks, scores
+
+def _render_round(task):
+    num, record, guides = task
+    codes, tricks, scores = _unpack(record)
+    img = PuzzleRound(num, codes, tricks, scores, guides=guides).make_card().img
+    return img.mode, img.size, img.tobytes()
+
+def render_rounds(records, guides="CS", start=1, workers=1, resources=None,
+                  batch=32):
+    # Renders (codes, tricks, scores) records, or dicts with those keys,
+    # lazily and in order, yielding (round number, card). Records are only
+    # pulled from the iterable as cards are consumed, so memory stays flat
+    # however many there are. Pool workers use their own resources.
+    records = iter(records)
+    if workers <= 1:
+        if resources is None:
+            resources = default_resources()
+        for idx, record in enumerate(records):
+            codes, tricks, scores = _unpack(record)
+            yield start + idx, PuzzleRound(start + idx, codes, tricks, scores,
+                                           guides=guides,
+                                           resources=resources).make_card()
+        return
+
+    import multiprocessing
+    default_resources() # built once here and inherited by forked workers
+    pool = multiprocessing.Pool(workers)
+    try:
+        num = start
+        while True:
+            # a bounded window, since the pool would otherwise read ahead
+            # through the whole input
+            tasks = [(num + idx, record, guides) for idx, record in
+                     enumerate(itertools.islice(records, batch * workers))]
+            if not tasks:
+                break
+            for mode, size, data in pool.imap(_render_round, tasks,
+                                              max(1, batch // 4)):
+                yield num, Card.from_image(Image.frombytes(mode, size, data))
+                num += 1
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
 if __name__ == "__main__":
     f = open("puzzle_data.json", "r")
     puzzle_data = json.loads(f.read())
@@ -0,0 +1,71 @@
+import sys
+import numpy as np
+from PIL import Image
+
+# Previews derived from one master render by repeated 2x2 box averaging,
+# which is cheaper than rendering again at a smaller scale. Where a block
+# is partly transparent the colour is averaged weighted by alpha (exactly,
+# where PIL's RGBA resize rounds premultiplied colours to 8 bits), so the
+# transparent corners outside the cut line don't darken the card edges.
+
+# a pixel's four channels as uint16 lanes of one uint64, little-endian
+ROUND = np.uint64(0x0002000200020002)
+LOW_BYTES = np.uint64(0x00ff00ff00ff00ff)
+
+def _half(a):
+    # a is an h x w x 4 uint8 array, h and w at least 2. An odd last row or
+    # column is dropped, so every output pixel is the average of exactly
+    # four input pixels.
+    h, w = a.shape[0] // 2, a.shape[1] // 2
+    a = a[:2 * h, :2 * w]
+    rows = np.add(a[0::2], a[1::2], dtype=np.uint16)
+    # adding neighbouring pixels as uint64 adds all four channels at once;
+    # no lane gets past 4 * 255, so none carries into the next
+    pairs = rows.view(np.uint64).reshape(h, w, 2)
+    total = pairs[:, :, 0] + pairs[:, :, 1]
+    alpha = total >> np.uint64(48)
+    total += ROUND
+    total >>= np.uint64(2)
+    total &= LOW_BYTES
+    out = total.view(np.uint8).reshape(h, w, 8)[:, :, 0::2].copy()
+    # the plain average is right where the block is all opaque or all
+    # transparent; the few blocks on the cut line get alpha weighting
+    # (alpha - 1 wraps around for alpha 0)
+    edge = np.flatnonzero(alpha - np.uint64(1) < np.uint64(4 * 255 - 1))
+    if len(edge):
+        ys, xs = 2 * (edge // w), 2 * (edge % w)
+        px = np.array([a[ys + dy, xs + dx] for dy in (0, 1) for dx in (0, 1)],
+                      np.uint32)
+        weight = px[:, :, 3:].sum(0)
+        color = (px[:, :, :3] * px[:, :, 3:]).sum(0)
+        out.reshape(h * w, 4)[edge, :3] = (color + weight // 2) // weight
+    return out
+
+def _fast(img):
+    return (img.mode == "RGBA" and min(img.size) >= 2 and
+            sys.byteorder == "little")
+
+def half(img):
+    if not _fast(img):
+        w, h = max(img.size[0] // 2, 1), max(img.size[1] // 2, 1)
+        return img.resize((w, h), Image.BOX, (0, 0, min(2 * w, img.size[0]),
+                                              min(2 * h, img.size[1])))
+    return Image.fromarray(_half(np.asarray(img)), "RGBA")
+
+def pyramid(img, levels=3):
+    # [1/2, 1/4, 1/8, ...] of img, each derived from the one before; the
+    # levels are halved as arrays, converting img only once
+    ret = []
+    arr = np.asarray(img) if _fast(img) else None
+    for _ in range(levels):
+        if arr is not None and min(arr.shape[:2]) >= 2:
+            arr = _half(arr)
+            img = Image.fromarray(arr, "RGBA")
+        else:
+            img, arr = half(img), None
+        ret.append(img)
+    return ret
+
+def level_name(level):
+    # subdirectory for a pyramid level: 1 -> "1_2", 3 -> "1_8"
+    return "1_%d" % (2 ** level)
@@ -0,0 +1,176 @@
+import json, hashlib
+from collections import OrderedDict
+
+import tracing
+from buffers import POOL
+from deckspec import Variant, special_art, face_art
+
+# Cards as a DAG of layer operations, so that what cards have in common is
+# drawn once. Every card starts from a blank base for its guides; face cards
+# share the frame around their art; and variants that differ only in the cut
+# (or the back) share everything before it.
+#
+#   plan = compile_plan(deck_jobs(puzzle_data), spec_variants())
+#   print(plan.describe())
+#   for job, variant, img in execute(plan, CardMaker()):
+#       ...
+#
+# A node is keyed by a hash of its op, params and inputs, so asking for the
+# same layer twice gets the same node. Executing the plan computes each node
+# once, on first use, and keeps it only until its last consumer has taken
+# it; every consumer but the last gets a copy.
+
+def _base(cm, card, guides):
+    return cm._card(guides)
+
+def _frame(cm, card):
+    cm.draw_frame(card)
+    return card
+
+def _pips(cm, card, num, suit, tilt=None):
+    cm.draw_pips(card, num, suit, tilt)
+    return card
+
+def _art(cm, card, filename, dims, offset):
+    cm.draw_art(card, filename, dims, offset)
+    return card
+
+def _corners(cm, card, num, suit):
+    cm._draw_corners(card, num, suit, allfour=True)
+    return card
+
+def _back(cm, card, color, stripe, ink):
+    card.draw_back(color, stripe, ink)
+    return card
+
+def _text(cm, card, guides):
+    # the puzzle cards draw on a card of their own
+    from puzzle_cards import PuzzleText
+    return PuzzleText(guides=guides, scale=cm.scale).make_card()
+
+def _round(cm, card, guides, num, codes, tricks, scores):
+    from puzzle_cards import PuzzleRound, default_resources
+    return PuzzleRound(num, codes, tricks, scores, guides=guides,
+                       resources=default_resources(cm.scale)).make_card()
+
+def _cut(cm, card):
+    card.flush(cut=True)
+    return card
+
+# op -> fn(card maker, input card or None, *params), returning the card
+OPS = {"base": _base, "frame": _frame, "pips": _pips, "art": _art,
+       "corners": _corners, "back": _back, "text": _text, "round": _round,
+       "cut": _cut}
+
+DEFAULT_BACK = ("#ea3944", None, None)
+
+
+class Node(object):
+    def __init__(self, key, op, params, deps):
+        self.key = key
+        self.op = op
+        self.params = params
+        self.deps = deps
+
+
+class RenderPlan(object):
+    def __init__(self):
+        self.nodes = OrderedDict()
+        # outputs are (job, variant, node key), in the order execute yields
+        # them; consumers counts the nodes and outputs using each node
+        self.outputs = []
+        self.consumers = {}
+        self.requested = 0
+
+    def add(self, op, params=(), deps=()):
+        params, deps = tuple(params), tuple(deps)
+        key = hashlib.sha1(json.dumps([op, params, deps]).encode(
+            "utf-8")).hexdigest()[:16]
+        self.requested += 1
+        if key not in self.nodes:
+            self.nodes[key] = Node(key, op, params, deps)
+            self.consumers[key] = 0
+            for dep in deps:
+                self.consumers[dep] += 1
+        return key
+
+    def add_output(self, job, variant, key):
+        self.outputs.append((job, variant, key))
+        self.consumers[key] += 1
+
+    def describe(self):
+        ops = {}
+        for node in self.nodes.values():
+            ops[node.op] = ops.get(node.op, 0) + 1
+        shared = sum(1 for key in self.nodes if self.consumers[key] > 1)
+        return ("%d outputs: %d layer ops instead of %d, %d of them shared "
+                "(%s)" % (len(self.outputs), len(self.nodes), self.requested,
+                          shared, ", ".join("%s %d" % item
+                                            for item in sorted(ops.items()))))
+
+
+def _card_node(plan, job, variant):
+    # the last node of a card before its cut
+    guides, args = variant.guides, job.args
+    if job.kind == "text":
+        return plan.add("text", (guides,))
+    if job.kind == "round":
+        return plan.add("round", (guides,) + args)
+
+    base = plan.add("base", (guides,))
+    if job.kind == "back":
+        return plan.add("back", variant.back or args or DEFAULT_BACK, (base,))
+    if job.kind == "special":
+        value = args[0]
+        art = args[1:] or special_art()[value]
+        key = plan.add("art", tuple(art) + ((0, 0),), (base,))
+        return plan.add("corners", (value, None), (key,))
+    if job.kind == "card":
+        num, suit = args[:2]
+        key = plan.add("pips", args, (base,))
+        return plan.add("corners", (num, suit), (key,))
+    if job.kind == "face":
+        num, suit = args[:2]
+        art = args[2:] or face_art()[suit][num - 11]
+        key = plan.add("frame", (), (base,))
+        key = plan.add("art", art, (key,))
+        return plan.add("corners", (num, suit), (key,))
+    assert False, job.kind
+
+def compile_plan(jobs, variants=None):
+    # outputs go card by card, each in every variant, so what a card's
+    # variants share is freed as soon as possible
+    variants = variants or [Variant()]
+    plan = RenderPlan()
+    for job in jobs:
+        for variant in variants:
+            key = _card_node(plan, job, variant)
+            if variant.cut:
+                key = plan.add("cut", (), (key,))
+            plan.add_output(job, variant, key)
+    return plan
+
+def execute(plan, cm):
+    # yields (job, variant, image) for each output; the images come from
+    # buffers.POOL
+    results = {}
+    remaining = dict(plan.consumers)
+
+    def take(key, name):
+        # a shared node is traced under the card that computes it first
+        if key not in results:
+            node = plan.nodes[key]
+            card = take(node.deps[0], name) if node.deps else None
+            with tracing.span("plan." + node.op, card=name,
+                              params=list(node.params)):
+                results[key] = OPS[node.op](cm, card, *node.params)
+        remaining[key] -= 1
+        if remaining[key]:
+            return results[key].copy()
+        return results.pop(key)
+
+    for job, variant, key in plan.outputs:
+        with POOL.track(job.name), tracing.span("render_job", card=job.name,
+                                                variant=variant.name):
+            img = take(key, job.name).flush()
+        yield job, variant, img
@@ -0,0 +1,119 @@
+import os, struct, zlib, threading
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+import numpy as np
+from PIL import Image
+from output import temp_file
+
+
+class SheetWriter(object):
+    # Writes a large RGBA PNG one band of scanlines at a time instead of
+    # holding the whole sheet in memory. Cards have to arrive row by row
+    # (non-decreasing y); every scanline above the newest card is final, so
+    # it is encoded and dropped. The band only needs to be as tall as the
+    # tallest card. With threaded=True, zlib runs on a background thread
+    # while the caller renders the next cards.
+    def __init__(self, path, size, band_height, compress_level=6,
+                 threaded=False):
+        self.width, self.height = size
+        self.band_height = band_height
+        self.top = 0
+        self.band = Image.new("RGBA", (self.width, band_height))
+
+        # written under a temporary name and renamed into place by close()
+        self.path = path
+        self._f, self._tmp = temp_file(path)
+        self._z = zlib.compressobj(compress_level)
+        self._pending = []
+        self._pending_size = 0
+
+        self._f.write(b"\x89PNG\r\n\x1a\n")
+        self._chunk(b"IHDR", struct.pack(">IIBBBBB", self.width, self.height,
+                                         8, 6, 0, 0, 0))
+
+        self._queue = self._thread = self._error = None
+        if threaded:
+            # a few chunks of filtered scanlines, to bound memory
+            self._queue = queue.Queue(4)
+            self._thread = threading.Thread(target=self._compress_loop)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def paste(self, img, xy):
+        x, y = xy
+        if max(y, 0) < self.top:
+            raise ValueError("cards must be added row by row")
+        self._flush(min(y, self.height))
+        # same as pasting into one full-size sheet
+        self.band.paste(img, (x, y - self.top), img)
+
+    def close(self):
+        self._flush(self.height)
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+            if self._error is not None:
+                raise self._error
+        self._idat(self._z.flush())
+        self._write_idat()
+        self._chunk(b"IEND", b"")
+        self._f.close()
+        os.rename(self._tmp, self.path)
+        self.band = None
+
+    def _flush(self, upto, step=64):
+        while self.top < upto:
+            n = min(upto - self.top, self.band_height)
+            # encode a few scanlines at a time to keep temporaries small
+            for y in range(0, n, step):
+                self._encode(self.band.crop((0, y, self.width, min(y + step, n))))
+
+            # move the rest of the band up and clear what's left below it
+            rest = self.band_height - n
+            if rest > 0:
+                self.band.paste(self.band.crop((0, n, self.width, self.band_height)),
+                                (0, 0))
+            self.band.paste((0, 0, 0, 0), (0, rest, self.width, self.band_height))
+            self.top += n
+
+    def _encode(self, rows):
+        rows = np.frombuffer(rows.tobytes(), np.uint8).reshape(rows.size[1], -1)
+        # PNG "Sub" filter: each byte minus the same channel one pixel left
+        filtered = np.empty((rows.shape[0], rows.shape[1] + 1), np.uint8)
+        filtered[:, 0] = 1
+        filtered[:, 1:5] = rows[:, :4]
+        filtered[:, 5:] = rows[:, 4:] - rows[:, :-4]
+        if self._queue is not None:
+            self._queue.put(filtered.tobytes())
+        else:
+            self._idat(self._z.compress(filtered.tobytes()))
+
+    def _compress_loop(self):
+        while True:
+            data = self._queue.get()
+            if data is None:
+                return
+            if self._error is None:
+                try:
+                    self._idat(self._z.compress(data))
+                except Exception as e:
+                    self._error = e
+
+    def _idat(self, data):
+        self._pending.append(data)
+        self._pending_size += len(data)
+        if self._pending_size >= 1 << 20:
+            self._write_idat()
+
+    def _write_idat(self):
+        if self._pending_size:
+            self._chunk(b"IDAT", b"".join(self._pending))
+        self._pending, self._pending_size = [], 0
+
+    def _chunk(self, kind, data):
+        self._f.write(struct.pack(">I", len(data)))
+        self._f.write(kind + data)
+        self._f.write(struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff))
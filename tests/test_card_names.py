@@ -0,0 +1,45 @@
+import os, json, shutil, tempfile, unittest
+
+from deckspec import load_spec
+from make_deck import load_jobs, select_jobs, normalize_card_name
+
+
+class CustomSuitTest(unittest.TestCase):
+    # card names are read against the suits of the spec being rendered, not
+    # deck.json's
+    def setUp(self):
+        spec = json.loads(json.dumps(load_spec()))
+        renames = dict(zip(spec["suits"], ["jade", "lotus", "blade", "coin"]))
+        spec["suits"] = [renames[suit] for suit in spec["suits"]]
+        for card in spec["cards"]:
+            if card["kind"] == "suit":
+                card["suit"] = renames[card["suit"]]
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "deck.json")
+        f = open(self.path, "w")
+        f.write(json.dumps(spec))
+        f.close()
+        self.spec = load_spec(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_normalize(self):
+        self.assertEqual(normalize_card_name("jade Q", self.spec), "jade12")
+        self.assertEqual(normalize_card_name("Coin a", self.spec), "coinA")
+
+    def test_select(self):
+        jobs = load_jobs(self.path)
+        names = [job.name for job in
+                 select_jobs(jobs, "jade Q,lotus*,coin t", self.spec)]
+        # in deck order
+        self.assertEqual(names, ["jade12", "lotusA"] +
+                         ["lotus%d" % n for n in range(2, 14)] + ["coin10"])
+
+    def test_default_suits_dont_match(self):
+        jobs = load_jobs(self.path)
+        self.assertRaises(ValueError, select_jobs, jobs, "gem5", self.spec)
+
+
+if __name__ == "__main__":
+    unittest.main()
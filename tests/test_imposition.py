@@ -0,0 +1,51 @@
+import os, json, shutil, tempfile, unittest
+
+from deckspec import load_spec
+from imposition import PageSpec, ImpositionPlan, PAGE_SIZES, MAX_BLEED
+from make_deck import make_pdf
+
+
+class PresetTest(unittest.TestCase):
+    def test_defaults_fit(self):
+        # every --page works without any other options
+        for page in sorted(PAGE_SIZES):
+            spec = PageSpec(page)
+            plan = ImpositionPlan(["card%d" % i for i in range(10)], spec)
+            self.assertTrue(plan.pages, page)
+
+    def test_poker(self):
+        spec = PageSpec("poker")
+        self.assertEqual((spec.cols, spec.rows), (1, 1))
+        self.assertEqual(spec.bleed, MAX_BLEED)
+        self.assertFalse(spec.crop_marks)
+
+    def test_poker_crop_marks(self):
+        with self.assertRaises(ValueError) as cm:
+            PageSpec("poker", crop_marks=True)
+        self.assertIn("crop marks", str(cm.exception))
+
+
+class DuplexTest(unittest.TestCase):
+    def setUp(self):
+        spec = json.loads(json.dumps(load_spec()))
+        spec["cards"] = [card for card in spec["cards"]
+                         if card["kind"] != "back"]
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "deck.json")
+        f = open(self.path, "w")
+        f.write(json.dumps(spec))
+        f.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_no_back(self):
+        with self.assertRaises(ValueError) as cm:
+            make_pdf(os.path.join(self.dir, "deck.pdf"),
+                     PageSpec(duplex="long"), deck_spec=self.path)
+        self.assertIn("back", str(cm.exception))
+        self.assertFalse(os.path.exists(os.path.join(self.dir, "deck.pdf")))
+
+
+if __name__ == "__main__":
+    unittest.main()
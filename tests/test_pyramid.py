@@ -0,0 +1,54 @@
+import unittest
+
+import numpy as np
+from PIL import Image
+
+from pyramid import half, pyramid
+
+
+def exact_half(img):
+    # the alpha-weighted 2x2 average in floating point; PIL's resize rounds
+    # premultiplied colours to 8 bits, so it is off by more at low alpha
+    a = np.asarray(img).astype(float)
+    h, w = a.shape[0] // 2, a.shape[1] // 2
+    blocks = a[:2 * h, :2 * w].reshape(h, 2, w, 2, 4)
+    alpha = blocks[..., 3:].sum((1, 3))
+    color = (blocks[..., :3] * blocks[..., 3:]).sum((1, 3))
+    color /= np.maximum(alpha, 1)
+    return np.concatenate([color, alpha / 4], 2)
+
+
+class HalfTest(unittest.TestCase):
+    def setUp(self):
+        # opaque, transparent and partly transparent areas, odd sized
+        rng = np.random.RandomState(0)
+        arr = rng.randint(0, 256, (61, 47, 4)).astype(np.uint8)
+        arr[:20, :, 3] = 255
+        arr[20:30, :, 3] = 0
+        arr[20:30, :, :3] = 0
+        self.img = Image.fromarray(arr, "RGBA")
+
+    def assertClose(self, got, img):
+        want = exact_half(img)
+        got = np.asarray(got).astype(float)
+        self.assertEqual(got.shape, want.shape)
+        visible = want[:, :, 3] > 0
+        self.assertLessEqual(abs(got - want)[visible].max(), 0.5)
+
+    def test_exact(self):
+        self.assertClose(half(self.img), self.img)
+
+    def test_levels(self):
+        levels = pyramid(self.img, 3)
+        self.assertEqual([img.size for img in levels],
+                         [(23, 30), (11, 15), (5, 7)])
+        self.assertClose(levels[2], levels[1])
+
+    def test_tiny(self):
+        img = Image.new("RGBA", (1, 3), (10, 20, 30, 128))
+        self.assertEqual([level.size for level in pyramid(img, 2)],
+                         [(1, 1), (1, 1)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,127 @@
+# Opt-in timing spans for the card pipeline.
+#
+#   tracing.enable()
+#   make_deck(...)
+#   tracing.write_chrome_trace("trace.json") # chrome://tracing or Perfetto
+#   print(tracing.format_summary())
+#
+# While disabled, span() hands back a shared no-op and @traced functions
+# cost one flag check per call.
+
+import os, time, json, threading, functools
+
+_enabled = False
+_spans = []
+_lock = threading.Lock()
+
+
+def enable():
+    global _enabled
+    _enabled = True
+
+def disable():
+    global _enabled
+    _enabled = False
+
+def is_enabled():
+    return _enabled
+
+def drain():
+    # removes and returns the spans recorded so far
+    global _spans
+    with _lock:
+        spans, _spans = _spans, []
+    return spans
+
+def add(spans):
+    # merge spans recorded elsewhere, e.g. in pool workers
+    with _lock:
+        _spans.extend(spans)
+
+
+class _NullSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NULL_SPAN = _NullSpan()
+
+class _Span(object):
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.time()
+        record = {"name": self.name, "ts": self.start * 1e6,
+                  "dur": (end - self.start) * 1e6, "pid": os.getpid(),
+                  "tid": threading.current_thread().ident, "args": self.args}
+        with _lock:
+            _spans.append(record)
+        return False
+
+def span(name, **args):
+    if not _enabled:
+        return _NULL_SPAN
+    return _Span(name, args)
+
+def traced(name, args=None):
+    # args, if given, is called with the function's arguments and returns
+    # a dict of identifiers (card number, suit, ...) to attach to the span
+    def wrap(fn):
+        @functools.wraps(fn)
+        def inner(*a, **kw):
+            if not _enabled:
+                return fn(*a, **kw)
+            with _Span(name, args(*a, **kw) if args else {}):
+                return fn(*a, **kw)
+        return inner
+    return wrap
+
+
+def chrome_trace():
+    with _lock:
+        spans = list(_spans)
+    events = []
+    for s in spans:
+        events.append({"name": s["name"], "cat": "card", "ph": "X",
+                       "ts": s["ts"], "dur": s["dur"], "pid": s["pid"],
+                       "tid": s["tid"], "args": s["args"]})
+    return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+def write_chrome_trace(path):
+    f = open(path, "w")
+    json.dump(chrome_trace(), f)
+    f.close()
+
+def summary():
+    # name -> count, total, mean and max duration in seconds
+    with _lock:
+        spans = list(_spans)
+    ret = {}
+    for s in spans:
+        entry = ret.setdefault(s["name"], {"count": 0, "total": 0.0, "max": 0.0})
+        dur = s["dur"] / 1e6
+        entry["count"] += 1
+        entry["total"] += dur
+        entry["max"] = max(entry["max"], dur)
+    for entry in ret.values():
+        entry["mean"] = entry["total"] / entry["count"]
+    return ret
+
+def format_summary():
+    lines = ["%-28s %6s %10s %10s %10s" % ("span", "count", "total ms",
+                                           "mean ms", "max ms")]
+    stats = summary()
+    for name in sorted(stats, key=lambda n: -stats[n]["total"]):
+        s = stats[name]
+        lines.append("%-28s %6d %10.1f %10.2f %10.2f" % (
+            name, s["count"], s["total"] * 1000, s["mean"] * 1000,
+            s["max"] * 1000))
+    return "\n".join(lines)
@@ -0,0 +1,128 @@
+import numpy as np
+from PIL import Image, ImageColor
+from cache import LRUCache
+from assets import ASSETS, SUITS_PATH
+from card import Card, W, H, SAFE_W, SAFE_H, cached_mask, card_box, px
+from composite import blend, _div255
+
+# Card backs and their themed variants. The geometry of a back (which pixels
+# are ground, which are hatch stripe, where the suits go) is rendered once
+# per template as an index map; each color variant is then a palette lookup
+# over that map plus two small suit pastes.
+
+# ["#2891c4", "#ddcb8d", "#5a8da6", "#ea3944", "#5f5f5f"]
+BACK_COLORS = {
+    "blue": "#2891c4",
+    "tan": "#ddcb8d",
+    "grayblue": "#5a8da6",
+    "pink": "#ea3944",
+    "darkgray": "#5f5f5f",
+}
+HATCH_COLORS = ("#ddcb8d", "#9e8634")
+
+# index map values; 0 leaves the card as it was
+GROUND, STRIPE = 1, 2
+
+TEMPLATES = LRUCache(maxsize=8)
+
+def hatch(size, period=70, width=10):
+    # diagonal crosshatch: a pixel is on a stripe if (x + y) or (x - y)
+    # falls within width of a multiple of period
+    w, h = size
+    xs = np.arange(w)
+    ys = np.arange(h)[:, None]
+    return (((xs + ys) % period < width) | ((xs - ys) % period < width))
+
+def _rgba(color):
+    return np.array(ImageColor.getcolor(color, "RGBA"), np.uint8)
+
+class BackTemplate(object):
+    def __init__(self, scale=1.0, supersample=1, pattern=False,
+                 assets=ASSETS):
+        self.scale = scale
+        size = (int(W * scale), int(H * scale))
+        m = np.asarray(cached_mask(size, card_box(SAFE_W, SAFE_H, scale),
+                                   px(40, scale), int(SAFE_W * scale - 1),
+                                   supersample))
+        index = np.where(m > 0, GROUND, 0).astype(np.uint8)
+        if pattern:
+            index[(m > 0) & hatch(size, max(px(70, scale), 2),
+                                  max(px(10, scale), 1))] = STRIPE
+
+        # only the rows and columns the back covers are looked up
+        ys, xs = np.nonzero(index)
+        self.box = (xs.min(), ys.min(), xs.max() + 1, ys.max() + 1)
+        x1, y1, x2, y2 = self.box
+        self.index = index[y1:y2, x1:x2]
+        self.cover = self.index > 0
+        # antialiased edge pixels (supersample > 1) are blended, not replaced
+        edge = np.nonzero((m[y1:y2, x1:x2] > 0) & (m[y1:y2, x1:x2] < 255))
+        self.edge = edge
+        self.edge_alpha = m[y1:y2, x1:x2][edge].astype(np.uint16)[:, None]
+
+        self.suits = assets.get(SUITS_PATH, px((256, 64), scale))
+        self.rotated = assets.get(SUITS_PATH, px((256, 64), scale), 180)
+        self.inked = {}
+
+    def palette(self, ground, stripe=None):
+        # one packed RGBA word per index, so the lookup moves whole pixels
+        lut = np.zeros((256, 4), np.uint8)
+        lut[GROUND] = _rgba(ground)
+        lut[STRIPE] = _rgba(stripe if stripe is not None else ground)
+        return lut.view(np.uint32)[:, 0]
+
+    def _ink(self, ink):
+        # the suits as a silhouette in one color, keeping their alpha
+        if ink not in self.inked:
+            sprites = []
+            for sprite in (self.suits, self.rotated):
+                flat = Image.new("RGBA", sprite.size, ink)
+                flat.putalpha(sprite.split()[3])
+                sprites.append(flat)
+            self.inked[ink] = sprites
+        return self.inked[ink]
+
+    def apply(self, buf, ground, stripe=None, ink=None):
+        # buf is the card's contiguous h x w x 4 uint8 array, changed in place
+        x1, y1, x2, y2 = self.box
+        region = buf[y1:y2, x1:x2]
+        pixels = buf.view(np.uint32)[y1:y2, x1:x2, 0]
+        lut = self.palette(ground, stripe)
+        if len(self.edge[0]):
+            old = region[self.edge].astype(np.uint16)
+        np.copyto(pixels, lut[self.index], where=self.cover)
+        if len(self.edge[0]):
+            a = self.edge_alpha
+            out = old * (255 - a)
+            out += region[self.edge] * a
+            region[self.edge] = _div255(out)
+
+        suits, rotated = (self.suits, self.rotated) if ink is None else \
+            self._ink(ink)
+        s = self.scale
+        for sprite, cy in ((suits, int(H*s/4)), (rotated, int(3*H*s/4))):
+            sw, sh = sprite.size
+            blend(buf, sprite, int(W*s/2) - sw/2, cy - sh/2)
+
+    def render(self, base, ground, stripe=None, ink=None):
+        buf = np.array(base)
+        self.apply(buf, ground, stripe, ink)
+        return Image.fromarray(buf, "RGBA")
+
+def back_template(scale=1.0, supersample=1, pattern=False, assets=ASSETS):
+    key = (scale, supersample, pattern, id(assets))
+    return TEMPLATES.get(key, lambda: BackTemplate(scale, supersample, pattern,
+                                                   assets))
+
+def render_backs(variants, guides="", supersample=1, scale=1.0):
+    # variants is a list of (name, ground, stripe, ink) with stripe and ink
+    # optional (None); yields (name, card image) with the cut applied, like
+    # render_job. All variants share one blank card and one template per
+    # pattern.
+    base = Card(guides=guides, supersample=supersample, scale=scale)
+    buf = np.array(base.img)
+    for name, ground, stripe, ink in variants:
+        template = back_template(scale, supersample, stripe is not None)
+        card = Card.from_image(template.render(buf, ground, stripe, ink),
+                               supersample, scale)
+        yield name, card.flush(cut=True)